@@ -18,6 +18,8 @@ setup(
     See http://trac-hacks.org/wiki/GitPlugin for more details.
     """,
     packages=['tracext', 'tracext.git'],
+    package_data={'tracext.git': ['templates/*.html']},
     namespace_packages=['tracext'],
-    entry_points = {'trac.plugins': 'git = tracext.git.git_fs'},
+    entry_points = {'trac.plugins': ['git = tracext.git.git_fs',
+                                     'git.search = tracext.git.search']},
     data_files=['COPYING','README'])
@@ -14,15 +14,23 @@
 
 from __future__ import with_statement
 
-import os, re, sys, time, weakref
+import os, re, sys, time, weakref, errno, struct
+from heapq import heappush, heappop
+from array import array
+from hashlib import sha1
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
 from collections import deque
+from itertools import count
 from functools import partial
-from threading import Lock
+from threading import Lock, Thread, Event
 from subprocess import Popen, PIPE
+from Queue import Queue, Empty
 import cStringIO
 #from traceback import print_stack
 
-__all__ = ["git_version", "GitError", "GitErrorSha", "Storage", "StorageFactory"]
+__all__ = ["git_version", "GitError", "GitErrorSha", "GitDiffTooLarge", "GitPipe",
+           "Commit", "RefFilter", "RefChangeDetector", "RefUpdateSpool", "Storage", "StorageFactory"]
 
 class GitError(Exception):
     pass
@@ -30,6 +38,130 @@ class GitError(Exception):
 class GitErrorSha(GitError):
     pass
 
+class GitDiffTooLarge(GitError):
+    pass
+
+class Commit(object):
+    """immutable parsed commit object
+
+    Records are shared by all users of the commit cache, hence must not
+    be modified. Shas are str, names and message unicode, timestamps int
+    and timezones interned str of the form '+hhmm'; additional headers
+    (e.g. 'encoding' or 'mergetag') are kept as (key, value) tuples."""
+
+    __slots__ = ('tree', 'parents', 'author', 'author_time', 'author_tz',
+                 'committer', 'committer_time', 'committer_tz', 'message', 'extra')
+
+    def __init__(self, tree, parents, author, author_time, author_tz,
+                 committer, committer_time, committer_tz, message, extra=()):
+        __set = super(Commit, self).__setattr__
+        __set('tree', tree)
+        __set('parents', parents)
+        __set('author', author)
+        __set('author_time', author_time)
+        __set('author_tz', author_tz)
+        __set('committer', committer)
+        __set('committer_time', committer_time)
+        __set('committer_tz', committer_tz)
+        __set('message', message)
+        __set('extra', extra)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Commit objects are immutable")
+
+    __delattr__ = __setattr__
+
+    def __repr__(self):
+        return "<Commit tree=%s parents=%r committer=%r>" % (self.tree, self.parents, self.committer)
+
+    @staticmethod
+    def parse(raw, encoding='utf-8'):
+        """parse raw commit object (headers, empty line, message) in a
+        single pass over its header lines"""
+        header, sep, message = raw.partition('\n\n')
+        if not header:
+            raise GitErrorSha
+
+        tree = None
+        parents = []
+        author = committer = (u'', 0, '+0000')
+        extra = []
+
+        def __user_time(value):
+            # '<name> <<email>> <timestamp> <tz>'
+            user, ts, tz = value.rsplit(None, 2)
+            return unicode(user, encoding, 'replace'), int(ts), intern(tz)
+
+        key = None
+        for line in header.split('\n'):
+            if line.startswith(' '):
+                # continuation line of multi-line header (e.g. 'gpgsig')
+                if extra and key not in ('tree', 'parent', 'author', 'committer'):
+                    extra[-1] = (extra[-1][0], extra[-1][1] + u'\n' + unicode(line[1:], encoding, 'replace'))
+                continue
+
+            key, _, value = line.partition(' ')
+            if key == 'parent':
+                parents.append(intern(value.strip()))
+            elif key == 'tree':
+                tree = value.strip()
+            elif key == 'author':
+                author = __user_time(value)
+            elif key == 'committer':
+                committer = __user_time(value)
+            else:
+                extra.append((intern(key), unicode(value, encoding, 'replace')))
+
+        return Commit(tree, tuple(parents),
+                      author[0], author[1], author[2],
+                      committer[0], committer[1], committer[2],
+                      unicode(message.rstrip('\n'), encoding, 'replace'), tuple(extra))
+
+class GitPipe(object):
+    "file-like object reading from the stdout of a running git process"
+
+    def __init__(self, proc):
+        self.__proc = proc
+        self.__stdout = proc.stdout
+
+    def read(self, size=-1):
+        return self.__stdout.read(size)
+
+    def fileno(self):
+        "file descriptor of the pipe, e.g. for os.read() or select()"
+        return self.__stdout.fileno()
+
+    def readline(self, size=-1):
+        return self.__stdout.readline(size)
+
+    def __iter__(self):
+        return iter(self.__stdout.readline, '')
+
+    def close(self):
+        "close pipe and reap git process (which may get terminated by SIGPIPE)"
+        if self.__proc is None:
+            return
+        self.__stdout.close()
+        self.__proc.wait()
+        self.__proc = None
+
+    def __del__(self):
+        self.close()
+
+def _iter_nul_tokens(stream, bufsize=0x10000):
+    "split stream of NUL-terminated fields (e.g. 'git ... -z' output) incrementally"
+    buf = ''
+    while True:
+        chunk = stream.read(bufsize)
+        if not chunk:
+            break
+        tokens = (buf + chunk).split('\0')
+        buf = tokens.pop()
+        for token in tokens:
+            yield token
+    if buf:
+        yield buf
+
 class GitCore:
     def __init__(self, git_dir=None, git_bin="git"):
         self.__git_bin = git_bin
@@ -59,6 +191,75 @@ class GitCore:
 
         return cStringIO.StringIO(stdout_data)
 
+    def stream(self, git_cmd, *cmd_args, **kwargs):
+        """execute git command and return a GitPipe streaming its stdout;
+        an optional 'input' string is fed to the process' stdin"""
+
+        input = kwargs.get('input')
+
+        p = Popen(self.__build_git_cmd(git_cmd, *cmd_args), bufsize=-1,
+                  stdin=PIPE if input is not None else None,
+                  stdout=PIPE, stderr=open(os.devnull, 'w'), close_fds=True)
+
+        if input is not None:
+            # feed stdin from a separate thread, as git may start
+            # writing to stdout before having consumed all its input
+            def __feed():
+                try:
+                    try:
+                        p.stdin.write(input)
+                    except IOError:
+                        pass # git terminated early
+                finally:
+                    p.stdin.close()
+            t = Thread(target=__feed)
+            t.setDaemon(True)
+            t.start()
+
+        return GitPipe(p)
+
+    def execute_concurrently(self, calls, max_workers=4):
+        """run independent git commands, given as (key, git_cmd, cmd_args)
+        tuples, with up to max_workers git processes at a time; yields
+        (key, file-like object of stdout) pairs in order of completion"""
+        calls = list(calls)
+
+        if max_workers <= 1 or len(calls) <= 1:
+            for key, git_cmd, cmd_args in calls:
+                yield key, self.__execute(git_cmd, *cmd_args)
+            return
+
+        pending = Queue()
+        for call in calls:
+            pending.put(call)
+        done = Queue()
+
+        def __worker():
+            while True:
+                try:
+                    key, git_cmd, cmd_args = pending.get_nowait()
+                except Empty:
+                    return
+                try:
+                    done.put((key, self.__execute(git_cmd, *cmd_args), None))
+                except:
+                    done.put((key, None, sys.exc_info()))
+
+        workers = [ Thread(target=__worker)
+                    for i in range(min(max_workers, len(calls))) ]
+        for t in workers:
+            t.setDaemon(True)
+            t.start()
+
+        for i in xrange(len(calls)):
+            key, result, exc_info = done.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield key, result
+
+        for t in workers:
+            t.join()
+
     def __getattr__(self, name):
         return partial(self.__execute, name.replace('_','-'))
 
@@ -73,45 +274,763 @@ class GitCore:
 
 # helper class for caching...
 class SizedDict(dict):
-    def __init__(self, max_size=0):
+    # with sizeof, footprint holds the sum of sizeof(value) over all values
+    def __init__(self, max_size=0, on_evict=None, sizeof=None):
         dict.__init__(self)
         self.__max_size = max_size
+        self.__on_evict = on_evict
+        self.__sizeof = sizeof
         self.__key_fifo = deque()
         self.__lock = Lock()
+        self.footprint = 0
 
     def __setitem__(self, name, value):
+        evicted = []
         with self.__lock:
             assert len(self) == len(self.__key_fifo) # invariant
 
             if not self.__contains__(name):
                 self.__key_fifo.append(name)
+            elif self.__sizeof:
+                self.footprint -= self.__sizeof(dict.__getitem__(self, name))
 
             rc = dict.__setitem__(self, name, value)
+            if self.__sizeof:
+                self.footprint += self.__sizeof(value)
 
             while len(self.__key_fifo) > self.__max_size:
-                self.__delitem__(self.__key_fifo.popleft())
+                evicted.append(self.pop(self.__key_fifo.popleft()))
+                if self.__sizeof:
+                    self.footprint -= self.__sizeof(evicted[-1])
 
             assert len(self) == len(self.__key_fifo) # invariant
 
-            return rc
+        if self.__on_evict:
+            for old_value in evicted:
+                self.__on_evict(old_value)
+
+        return rc
+
+    def clear(self):
+        with self.__lock:
+            dict.clear(self)
+            self.__key_fifo.clear()
+            self.footprint = 0
 
     def setdefault(k,d=None):
         # TODO
         raise AttributeError("SizedDict has no setdefault() method")
 
+class _Future(object):
+    "result of a load in progress, waited for by concurrent requesters"
+
+    def __init__(self):
+        self.__done = Event()
+        self.__value = None
+        self.__exc_info = None
+
+    def set(self, value=None, exc_info=None):
+        self.__value = value
+        self.__exc_info = exc_info
+        self.__done.set()
+
+    def result(self):
+        self.__done.wait()
+        if self.__exc_info:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__value
+
+class LoadingCache(object):
+    """SizedDict based cache filled by a loader function on misses
+
+    The loader is passed on each lookup (instead of being kept, which
+    would usually create a reference cycle with its owner). Cached
+    values are read without locking. The lock is only held for
+    bookkeeping, never while loading: misses for different keys load in
+    parallel, while concurrent misses for the same key wait for the one
+    load in progress (and share its result or exception)."""
+
+    def __init__(self, max_size, on_evict=None, sizeof=None):
+        self.__cache = SizedDict(max_size, on_evict, sizeof)
+        self.__pending = {}
+        self.__lock = Lock()
+
+    def get(self, key, loader):
+        "return cached value for key, calling loader(key) if missing"
+        try:
+            return self.__cache[key]
+        except KeyError:
+            pass
+
+        with self.__lock:
+            try:
+                return self.__cache[key]
+            except KeyError:
+                pass
+
+            future = self.__pending.get(key)
+            if future is not None:
+                loading = False
+            else:
+                loading = True
+                future = self.__pending[key] = _Future()
+
+        if not loading:
+            return future.result()
+
+        try:
+            value = loader(key)
+        except:
+            exc_info = sys.exc_info()
+            with self.__lock:
+                del self.__pending[key]
+            future.set(exc_info=exc_info)
+            raise
+
+        with self.__lock:
+            self.__cache[key] = value
+            del self.__pending[key]
+        future.set(value)
+
+        return value
+
+    def lookup(self, key, default=None):
+        "return cached value for key without loading it"
+        return self.__cache.get(key, default)
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__cache[key] = value
+
+    def values(self):
+        return self.__cache.values()
+
+    def footprint(self):
+        "sum of sizeof(value) over the cached values, as passed to __init__"
+        return self.__cache.footprint
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+
+    def __len__(self):
+        return len(self.__cache)
+
+class HistoryWalk(object):
+    """resumable path-limited history walk
+
+    (rev, path) entries are read incrementally from a streaming git
+    process and kept, so paging through the history of a path continues
+    where the previous page stopped instead of restarting the walk.
+    With follow=True, renames are followed via 'git log --follow' and
+    path denotes the name of the node in the respective rev.
+
+    The git process of an incomplete walk blocks on its full pipe until
+    more entries are read, so close() stops it; reading beyond the
+    entries kept then restarts the walk, skipping those."""
+
+    def __init__(self, repo, sha, path, follow=False):
+        self.__lock = Lock()
+        self.__entries = []
+        self.__repo = repo
+        self.__sha = sha
+        self.__path = path
+        self.__follow = follow
+        self.__pipe = self.__iter = None
+        self.complete = False
+        self.last_used = time.time()
+
+    def __start(self):
+        # recent git rejects an empty pathspec; the root has no renames
+        if self.__follow and self.__path:
+            self.__pipe = self.__repo.stream("log", "--follow", "-z", "--name-only",
+                                             "--format=%x01%H", self.__sha, "--", self.__path)
+            self.__iter = self.__iter_follow()
+        else:
+            args = self.__path and [self.__sha, "--", self.__path] or [self.__sha]
+            self.__pipe = self.__repo.stream("rev-list", *args)
+            self.__iter = self.__iter_revs()
+
+        # skip the entries read by a previous (closed) process
+        for i in xrange(len(self.__entries)):
+            self.__iter.next()
+
+    def close(self):
+        "stop the git process of an incomplete walk, keeping the entries read"
+        with self.__lock:
+            if self.__pipe is not None:
+                self.__pipe.close()
+                self.__pipe = self.__iter = None
+
+    def __iter_revs(self):
+        for rev in self.__pipe:
+            yield rev.strip(), self.__path
+
+    def __iter_follow(self):
+        # fields are '\x01<sha>' followed by the path touched (if any)
+        rev, path = None, self.__path
+        for token in _iter_nul_tokens(self.__pipe):
+            token = token.lstrip('\n')
+            if token.startswith('\x01'):
+                if rev:
+                    yield rev, path
+                rev = token[1:]
+            elif token:
+                path = token
+        if rev:
+            yield rev, path
+
+    def __extend(self, count):
+        "read entries until there are count of them or the walk is complete"
+        with self.__lock:
+            self.last_used = time.time()
+            while not self.complete and (count is None or len(self.__entries) < count):
+                if self.__iter is None:
+                    self.__start()
+                try:
+                    self.__entries.append(self.__iter.next())
+                except StopIteration:
+                    self.complete = True
+                    self.__pipe.close()
+                    self.__pipe = self.__iter = None
+
+    def entries(self, offset=0, limit=None):
+        "return list of (rev, path) tuples"
+        self.__extend(limit is not None and offset + limit or None)
+        if limit is None:
+            return self.__entries[offset:]
+        return self.__entries[offset:offset+limit]
+
+    def revs(self, offset=0, limit=None):
+        return [ rev for rev, path in self.entries(offset, limit) ]
+
+    def __len__(self):
+        "number of entries read so far"
+        return len(self.__entries)
+
+    def is_last(self, index):
+        "whether the entry at index is the oldest one of the history"
+        self.__extend(index + 2)
+        return self.complete and index == len(self.__entries) - 1
+
+class _Inotify(object):
+    "minimal non-blocking inotify(7) binding (Linux only)"
+
+    IN_MODIFY      = 0x00000002
+    IN_ATTRIB      = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_ONLYDIR     = 0x01000000
+
+    IN_NONBLOCK    = 0x00000800
+    IN_CLOEXEC     = 0x00080000
+
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+    def __init__(self):
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.__add_watch = libc.inotify_add_watch
+        self.__fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1() failed")
+        self.__wds = {}
+
+    def watch(self, path):
+        "add (or refresh) watch on directory path; returns watch descriptor"
+        wd = self.__add_watch(self.__fd, path, self.WATCH_MASK)
+        if wd >= 0:
+            self.__wds[wd] = path
+        return wd
+
+    def read_events(self):
+        "return list of pending (path, mask, name) events without blocking"
+        events = []
+        while True:
+            try:
+                buf = os.read(self.__fd, 0x10000)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, name_len = struct.unpack_from('iIII', buf, pos)
+                pos += 16
+                name = buf[pos:pos+name_len].rstrip('\0')
+                pos += name_len
+                events.append((self.__wds.get(wd), mask, name))
+        return events
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+    def __del__(self):
+        self.close()
+
+class RefFilter(object):
+    """selects the refs whose history is covered by the commit tree db
+
+    Patterns are shell globs matched against full refnames (e.g.
+    'refs/pull/*'); a pattern without wildcards also matches all refs
+    below it, like for 'git for-each-ref'. A ref is selected if it
+    matches any include pattern (all refs if there are none) and no
+    exclude pattern. HEAD is always selected."""
+
+    def __init__(self, include=(), exclude=()):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+
+    def __nonzero__(self):
+        "False if all refs are selected"
+        return bool(self.include or self.exclude)
+
+    @staticmethod
+    def __matches(refname, patterns):
+        for pattern in patterns:
+            if fnmatchcase(refname, pattern) or \
+                    refname.startswith(pattern.rstrip('/') + '/'):
+                return True
+        return False
+
+    def __call__(self, refname):
+        if self.include and not self.__matches(refname, self.include):
+            return False
+        return not self.__matches(refname, self.exclude)
+
+    def __repr__(self):
+        return "<RefFilter include=%r exclude=%r>" % (self.include, self.exclude)
+
+class RefChangeDetector(object):
+    """cheaply detect changes of HEAD, 'packed-refs' and the loose refs
+
+    In the common no-change case only HEAD, 'packed-refs' and the
+    directories below 'refs/' are stat()ed (as git updates loose refs by
+    renaming lock files, any ref update changes its directory's
+    mtime). Only if that stat signature changes, the ref files are read
+    and hashed, so e.g. a 'git pack-refs' doesn't count as change.
+    With inotify, not even the stat() calls are needed while no events
+    arrive for the watched directories. Refs not selected by ref_filter
+    don't contribute to the fingerprint."""
+
+    # mtimes this close to the last scan are not trusted (cf. "racy git")
+    RACY_SECONDS = 2.0
+
+    def __init__(self, git_dir, log, use_inotify=False, ref_filter=None):
+        self.logger = log
+        self.__git_dir = git_dir
+        self.__ref_filter = ref_filter or None
+        self.__refs_dir = os.path.join(git_dir, 'refs')
+        self.__lock = Lock()
+        self.__ref_dirs = []
+        self.__stat_sig = None
+        self.__racy = True
+        self.__fingerprint = None
+
+        self.__inotify = None
+        if use_inotify:
+            try:
+                self.__inotify = _Inotify()
+                self.__inotify.watch(git_dir)
+            except (OSError, AttributeError, ImportError), e:
+                self.logger.warning("inotify not available, falling back to"
+                                    " polling ref files (%s)" % e)
+                self.__inotify = None
+
+    def __stat_signature(self):
+        sig = []
+        for path in [os.path.join(self.__git_dir, 'HEAD'),
+                     os.path.join(self.__git_dir, 'packed-refs')] + self.__ref_dirs:
+            try:
+                st = os.stat(path)
+            except OSError:
+                sig.append(None)
+            else:
+                sig.append((st.st_mtime, st.st_ino, st.st_size))
+        return sig
+
+    def __scan(self):
+        "read all ref files; returns content fingerprint"
+        def __read(path):
+            try:
+                f = open(path, 'rb')
+                try:
+                    return f.read()
+                finally:
+                    f.close()
+            except IOError:
+                return None
+
+        refs = {}
+        for line in (__read(os.path.join(self.__git_dir, 'packed-refs')) or '').splitlines():
+            if line and line[0] not in '#^':
+                sha, name = line.split(None, 1)
+                refs[name] = sha
+
+        # loose refs take precedence over packed ones
+        ref_dirs = []
+        for root, dirs, files in os.walk(self.__refs_dir):
+            ref_dirs.append(root)
+            for fname in files:
+                if fname.endswith('.lock'):
+                    continue
+                path = os.path.join(root, fname)
+                value = (__read(path) or '').strip()
+                if value:
+                    name = 'refs/' + path[len(self.__refs_dir)+1:].replace(os.sep, '/')
+                    refs[name] = value
+
+        if self.__inotify:
+            for root in ref_dirs:
+                self.__inotify.watch(root)
+
+        self.__ref_dirs = ref_dirs
+
+        # HEAD is always included, whatever the filter says: a detached
+        # HEAD's sha is hashed as is, a symbolic one's branch is kept
+        head = (__read(os.path.join(self.__git_dir, 'HEAD')) or '').strip()
+        if self.__ref_filter:
+            head_ref = head.startswith('ref:') and head[4:].strip() or None
+            refs = dict((name, value) for name, value in refs.iteritems()
+                        if name == head_ref or self.__ref_filter(name))
+
+        h = sha1(head)
+        for name, value in sorted(refs.iteritems()):
+            h.update('\0%s %s' % (name, value))
+        return h.hexdigest()
+
+    def fingerprint(self):
+        "return content fingerprint of all refs"
+        with self.__lock:
+            if self.__inotify and self.__fingerprint and not self.__racy:
+                events = [ e for e in self.__inotify.read_events()
+                           if e[0] != self.__git_dir or
+                           e[2] in ('HEAD', 'packed-refs', 'refs') or
+                           e[1] & _Inotify.IN_Q_OVERFLOW ]
+                if not events:
+                    return self.__fingerprint
+
+            scan_time = time.time()
+            stat_sig = self.__stat_signature()
+            if self.__fingerprint and not self.__racy and stat_sig == self.__stat_sig:
+                return self.__fingerprint
+
+            fingerprint = self.__scan()
+            if fingerprint != self.__fingerprint:
+                self.logger.debug("detected ref changes in '%s'" % self.__git_dir)
+
+            # re-stat, as __scan() may have discovered new ref directories
+            stat_sig = self.__stat_signature()
+            self.__racy = any(sig and sig[0] >= scan_time - self.RACY_SECONDS
+                              for sig in stat_sig)
+            self.__stat_sig = stat_sig
+            self.__fingerprint = fingerprint
+
+            return fingerprint
+
+class RefUpdateSpool(object):
+    """directory the post-receive hook (contrib/trac-post-receive) drops
+    the ref updates of each push into, as a file of '<old> <new> <refname>'
+    lines
+
+    Files are not removed when consumed, as several processes may be
+    watching the same spool; each consumer remembers the files it has
+    seen, and files older than MAX_AGE seconds are removed by whichever
+    consumer notices them first.
+
+    Within a process, each spool is watched by a single consumer thread
+    applying the updates to all Storage instances registered for it
+    (cf. watch())."""
+
+    MAX_AGE = 600
+
+    # spool path -> RefUpdateSpool with a running consumer
+    __spools = {}
+    __spools_lock = Lock()
+
+    @classmethod
+    def watch(cls, path, storage, consumer, log):
+        """register storage for the updates of the spool at path; unless
+        the spool is watched already, consumer(spool) is started as a
+        daemon thread, which is expected to apply the updates to the
+        registered Storage instances and to end once release() says so"""
+        with cls.__spools_lock:
+            spool = cls.__spools.get(path)
+            if spool is None:
+                spool = cls.__spools[path] = cls(path, log)
+                t = Thread(target=consumer, args=(spool,))
+                t.setDaemon(True)
+                t.start()
+            spool.storages[id(storage)] = storage
+        return spool
+
+    def release(self):
+        """unregister the spool if no Storage instance is registered for
+        it anymore; returns whether its consumer should end"""
+        with RefUpdateSpool.__spools_lock:
+            if self.storages:
+                return False
+            if RefUpdateSpool.__spools.get(self.path) is self:
+                del RefUpdateSpool.__spools[self.path]
+            return True
+
+    def __init__(self, path, log):
+        self.logger = log
+        self.path = path
+        # registered Storage instances by id
+        self.storages = weakref.WeakValueDictionary()
+        # files present on startup are covered by the initial cache build
+        self.__seen = set(self.__list())
+
+    def __list(self):
+        try:
+            return [ name for name in os.listdir(self.path) if not name.startswith('.') ]
+        except OSError:
+            return []
+
+    def poll(self):
+        "return list of (old, new, refname) updates from new spool files, oldest first"
+        names = self.__list()
+        updates = []
+        for name in sorted(set(names) - self.__seen):
+            try:
+                f = open(os.path.join(self.path, name), 'rb')
+                try:
+                    lines = f.read().splitlines()
+                finally:
+                    f.close()
+            except IOError:
+                continue # pruned by another consumer meanwhile
+            for line in lines:
+                fields = line.split()
+                if len(fields) == 3:
+                    updates.append(tuple(fields))
+        self.__seen = set(names)
+
+        expired = time.time() - self.MAX_AGE
+        for name in names:
+            path = os.path.join(self.path, name)
+            try:
+                if os.stat(path).st_mtime < expired:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+        return updates
+
+def _build_rev_db(revs, times, parents):
+    """build commit tree db from parallel lists of revs, timestamps and
+    parent tuples in 'git rev-list' order (youngest first), with equal
+    rev strings expected to be shared objects; returns (youngest, oldest,
+    db, sdb, timeline) with db[rev] = (children, parents, ordinal)
+
+    Revs get integer ids (their index, i.e. ordinal - 1) via a single
+    dict; parent links are collected in flat arrays from which the
+    children lists are derived by a counting sort, so children keep
+    the order in which they appear in the rev-list output."""
+    n = len(revs)
+
+    ids = dict(zip(revs, xrange(n)))
+    if len(ids) != n:
+        raise GitError("duplicate revisions in commit list")
+
+    # a commit is listed only once among its parent's children
+    edges = parents
+    dups = [ i for i, _parents in enumerate(parents)
+             if len(_parents) > 1 and len(set(_parents)) != len(_parents) ]
+    if dups:
+        edges = parents[:]
+        for i in dups:
+            edges[i] = [ p for j, p in enumerate(parents[i]) if p not in parents[i][:j] ]
+
+    # edges as flat arrays of (child id, parent id)
+    try:
+        edge_parent = array('i', [ ids[p] for _parents in edges for p in _parents ])
+    except KeyError, e:
+        raise GitError("parent %s missing in commit list" % e)
+    edge_child = array('i', [ child for child, _parents in enumerate(edges) for p in _parents ])
+    edges = None
+
+    # counting sort by parent: children of id i are at [starts[i]:starts[i+1]]
+    starts = [0] * (n + 1)
+    for pid in edge_parent:
+        starts[pid + 1] += 1
+    for i in xrange(n):
+        starts[i + 1] += starts[i]
+    fill = starts[:]
+    children = [None] * len(edge_child)
+    for child, pid in zip(edge_child, edge_parent):
+        children[fill[pid]] = revs[child]
+        fill[pid] += 1
+    edge_child = edge_parent = fill = None
+
+    db = dict(zip(revs, zip([ tuple(children[starts[i]:starts[i+1]]) for i in xrange(n) ],
+                            parents, xrange(1, n + 1))))
+    children = None
+
+    # shortrev "hash" map
+    groups = {}
+    for key, rev in zip([ int(rev[:4], 16) for rev in revs ], revs):
+        try:
+            groups[key].append(rev)
+        except KeyError:
+            groups[key] = [rev]
+
+    # store sdb either as dict or array depending on size
+    sdb = [()]*(max(groups.keys())+1) if len(groups) > 5000 else {}
+    for key, _revs in groups.iteritems():
+        sdb[key] = tuple(_revs)
+    groups = None
+
+    # timeline sorted by timestamp, for equal timestamps the older
+    # ordinal first; stable sort of descending ids achieves the latter
+    order = range(n - 1, -1, -1)
+    order.sort(key=times.__getitem__)
+    timeline = ([ times[i] for i in order ], [ revs[i] for i in order ])
+
+    # first rev seen is the youngest one (ordinal 1), last the oldest
+    youngest = n and revs[0] or None
+    oldest = n and revs[-1] or None
+
+    return youngest, oldest, db, sdb, timeline
+
+def _runs(ordinals):
+    """run-length encode a list of distinct ordinals (sorted in place) as
+    array of [start, end) bounds, i.e. a compressed bitmap; an ordinal is
+    contained iff bisect_right(bounds, ordinal) is odd"""
+    ordinals.sort()
+    bounds = array('i')
+    end = None
+    for ordinal in ordinals:
+        if ordinal != end:
+            if end is not None:
+                bounds.append(end)
+            bounds.append(ordinal)
+        end = ordinal + 1
+    if end is not None:
+        bounds.append(end)
+    return bounds
+
+def _union_runs(runs_list):
+    """union of run-length encoded bitmaps
+
+    The runs of the others are spliced into a copy of the largest bitmap,
+    which is cheap as long as they are few (e.g. the new commits on top
+    of an ancestor's bitmap)."""
+    if len(runs_list) == 1:
+        return runs_list[0]
+
+    runs_list = sorted(runs_list, key=len)
+    result = array('i', runs_list.pop())
+    for bounds in runs_list:
+        for i in xrange(0, len(bounds), 2):
+            start, end = bounds[i], bounds[i+1]
+            # result[lo:hi] are the bounds within or adjacent to the run;
+            # an odd index means that start (end) is within a run already
+            lo = bisect_left(result, start)
+            hi = bisect_right(result, end)
+            splice = array('i')
+            if not lo & 1:
+                splice.append(start)
+            if not hi & 1:
+                splice.append(end)
+            result[lo:hi] = splice
+    return result
+
+def _build_reach_runs(db, tips, known=None, anchor_every=128):
+    """return dict mapping revs to the run-length encoded bitmaps of the
+    ordinals of all commits reachable from them (themselves included),
+    for all of tips and, unless known is given, every anchor_every-th
+    commit of db
+
+    Each bitmap is made up from a walk over the ancestors which stops at
+    commits whose bitmap is known already; known holds the bitmaps of a
+    previous call for the same db (or an extension of it). Anchors keep
+    these walks short, they are computed oldest first, so that walks
+    find the bitmaps of older anchors and tips ready."""
+    if known is None:
+        runs = {}
+        stops = set(rev for rev, entry in db.iteritems() if entry[2] % anchor_every == 0)
+    else:
+        runs = dict(known)
+        stops = set()
+    stops.update(tip for tip in tips if tip not in runs)
+
+    for stop in sorted(stops, key=lambda rev: -db[rev][2]):
+        ordinals = [db[stop][2]]
+        found = []
+        seen = set(db[stop][1]) # parents may be listed twice
+        todo = list(seen)
+        while todo:
+            rev = todo.pop()
+            if rev in runs:
+                found.append(rev)
+                continue
+            _, parents, ordinal = db[rev]
+            ordinals.append(ordinal)
+            for parent in parents:
+                if parent not in seen:
+                    seen.add(parent)
+                    todo.append(parent)
+
+        # bitmaps of revs reachable from another one found add nothing
+        parts = [_runs(ordinals)]
+        for rev in sorted(found, key=lambda rev: -len(runs[rev])):
+            ordinal = db[rev][2]
+            for bounds in parts:
+                if bisect_right(bounds, ordinal) & 1:
+                    break
+            else:
+                parts.append(runs[rev])
+        runs[stop] = _union_runs(parts)
+
+    return runs
+
 class StorageFactory:
+    """shares one Storage per repository path
+
+    With a memory budget (in bytes, 0 means unlimited) the estimated
+    cache footprints of all live Storage instances are summed up on
+    each access, and the caches of the least recently used repositories
+    are dropped until the total fits into the budget again."""
+
     __dict = weakref.WeakValueDictionary()
     __dict_nonweak = dict()
     __dict_lock = Lock()
 
-    def __init__(self, repo, log, weak=True, git_bin='git'):
+    # budget accounting: __last_used[repo] = access serial
+    __memory_budget = 0
+    __last_used = dict()
+    __serial = 0
+    __evictions = 0
+
+    def __init__(self, repo, log, weak=True, git_bin='git',
+                 rebuild_in_background=False, max_staleness=0, use_inotify=False,
+                 max_concurrency=4, memory_budget=0, ref_filter=None,
+                 notify_spool=None):
         self.logger = log
 
         with StorageFactory.__dict_lock:
+            StorageFactory.__memory_budget = memory_budget
+
             try:
                 i = StorageFactory.__dict[repo]
             except KeyError:
-                i = Storage(repo, log, git_bin)
+                i = Storage(repo, log, git_bin,
+                            rebuild_in_background=rebuild_in_background,
+                            max_staleness=max_staleness,
+                            use_inotify=use_inotify,
+                            max_concurrency=max_concurrency,
+                            ref_filter=ref_filter,
+                            notify_spool=notify_spool)
                 StorageFactory.__dict[repo] = i
 
                 # create or remove additional reference depending on 'weak' argument
@@ -130,8 +1049,91 @@ class StorageFactory:
         is_weak = self.__repo not in StorageFactory.__dict_nonweak
         self.logger.debug("requested %sPyGIT.Storage instance %d for '%s'"
                           % (("","weak ")[is_weak], id(self.__inst), self.__repo))
+
+        victims = []
+        with StorageFactory.__dict_lock:
+            StorageFactory.__serial += 1
+            StorageFactory.__last_used[self.__repo] = StorageFactory.__serial
+            if StorageFactory.__memory_budget > 0:
+                victims = self.__select_victims()
+
+        # clearing takes each Storage's locks, so not under __dict_lock
+        for repo, inst in victims:
+            inst.clear_caches()
+
         return self.__inst
 
+    # called with StorageFactory.__dict_lock held
+    def __select_victims(self):
+        "return list of (repo, Storage) whose caches to drop for the budget"
+        budget = StorageFactory.__memory_budget
+        storages = StorageFactory.__dict.items()
+
+        footprints = dict((repo, inst.cache_footprint()) for repo, inst in storages)
+        total = sum(footprints.itervalues())
+        if total <= budget:
+            return []
+
+        # least recently used first; the requested repository is evicted last
+        lru = [ (repo != self.__repo, StorageFactory.__last_used.get(repo, 0), repo, inst)
+                for repo, inst in storages ]
+        lru.sort()
+        lru.reverse()
+        victims = []
+        while total > budget and lru:
+            _, _, repo, inst = lru.pop()
+            if not footprints[repo]:
+                continue
+            self.logger.info("cache budget of %d bytes exceeded (%d bytes),"
+                             " dropping caches of '%s'" % (budget, total, repo))
+            victims.append((repo, inst))
+            total -= footprints[repo]
+            StorageFactory.__evictions += 1
+        return victims
+
+    @staticmethod
+    def clear(repo):
+        """drop the caches of the live Storage instance for repo, without
+        touching the memory budget; returns False if there is none"""
+        with StorageFactory.__dict_lock:
+            inst = StorageFactory.__dict.get(repo)
+        if inst is None:
+            return False
+        inst.clear_caches()
+        return True
+
+    @staticmethod
+    def stats():
+        """return cache statistics of all live Storage instances
+
+        The result is a dict with the keys 'budget', 'total', 'evictions'
+        and 'repositories', the latter being a list of dicts (most
+        recently used first) with the keys 'path', 'persistent',
+        'footprint' and 'last_used' (0 for the most recent access)."""
+        with StorageFactory.__dict_lock:
+            serial = StorageFactory.__serial
+            repos = []
+            for repo, inst in StorageFactory.__dict.items():
+                last_used = StorageFactory.__last_used.get(repo)
+                if last_used is not None:
+                    last_used = serial - last_used
+                repos.append({'path': repo,
+                              'persistent': repo in StorageFactory.__dict_nonweak,
+                              'footprint': inst.cache_footprint(),
+                              'last_used': last_used})
+
+            # forget access times of collected instances
+            for repo in StorageFactory.__last_used.keys():
+                if repo not in StorageFactory.__dict:
+                    del StorageFactory.__last_used[repo]
+
+            repos.sort(key=lambda r: r['last_used'] is None and sys.maxint or r['last_used'])
+
+            return {'budget': StorageFactory.__memory_budget,
+                    'total': sum([ r['footprint'] for r in repos ]),
+                    'evictions': StorageFactory.__evictions,
+                    'repositories': repos}
+
 class Storage:
     __SREV_MIN = 4 # minimum short-rev length
 
@@ -174,7 +1176,9 @@ class Storage:
         except:
             raise GitError("Could not retrieve GIT version")
 
-    def __init__(self, git_dir, log, git_bin='git'):
+    def __init__(self, git_dir, log, git_bin='git',
+                 rebuild_in_background=False, max_staleness=0, use_inotify=False,
+                 max_concurrency=4, ref_filter=None, notify_spool=None):
         self.logger = log
 
         # simple sanity checking
@@ -192,147 +1196,547 @@ class Storage:
 
         self.repo = GitCore(git_dir, git_bin=git_bin)
 
+        # refs covered by the commit tree db and the ref listings
+        self.__ref_filter = ref_filter or None
+
+        self.__refs = RefChangeDetector(git_dir, log, use_inotify, self.__ref_filter)
+
+        # upper limit for git processes run in parallel for batched lookups
+        self.__max_concurrency = max_concurrency
+
         self.commit_encoding = None
 
         # caches
         self.__rev_cache = None
         self.__rev_cache_lock = Lock()
 
+        # stale-while-revalidate state for background rebuilds
+        self.__rebuild_in_background = rebuild_in_background
+        self.__max_staleness = max_staleness
+        self.__rev_cache_stale_since = None
+        self.__rev_cache_target = None
+        self.__rev_cache_worker = None
+        self.__rev_cache_swapped = False
+
         # cache the last 200 commit messages
-        self.__commit_msg_cache = SizedDict(200)
-        self.__commit_msg_lock = Lock()
+        self.__commit_msg_cache = LoadingCache(200, sizeof=lambda commit:
+                                               self.__COMMIT_ENTRY_SIZE + len(commit.message))
 
         # cache the last 2000 file sizes
-        self.__fs_obj_size_cache = SizedDict(2000)
-        self.__fs_obj_size_lock = Lock()
+        self.__fs_obj_size_cache = LoadingCache(2000)
+
+        # classification of blobs by their leading bytes
+        self.__blob_probe_cache = LoadingCache(2000)
+
+        # resumable history walks; never stale, as they start from a sha
+        self.__history_walks = LoadingCache(20, HistoryWalk.close)
+
+        # rename events per commit, extended by sync() after ref changes
+        self.__rename_index = None
+        self.__rename_index_lock = Lock()
+
+        # branch/tag metadata, invalidated by ref changes
+        self.__git_dir = git_dir
+        self.__ref_cache = None
+        self.__ref_cache_lock = Lock()
+
+        # ref updates pushed by the post-receive hook are applied in the
+        # background, ahead of sync()
+        self.__spool = None
+        if notify_spool:
+            self.__spool = RefUpdateSpool.watch(notify_spool, self,
+                                                Storage.__spool_consumer, log)
 
     def __del__(self):
         self.logger.debug("PyGIT.Storage instance %d destructed" % id(self))
 
+    # rough per-entry sizes in bytes (CPython, 32/64bit average) used for
+    # estimating the memory held by the caches
+    __REV_ENTRY_SIZE = 400      # db/sdb/timeline entries per commit
+    __REF_ENTRY_SIZE = 300
+    __COMMIT_ENTRY_SIZE = 1200  # plus length of the commit message
+    __OBJ_SIZE_ENTRY_SIZE = 150
+    __HISTORY_ENTRY_SIZE = 200
+    __RENAME_ENTRY_SIZE = 100
+    __REACH_ENTRY_SIZE = 100    # plus 4 bytes per bitmap run bound (or ref)
+
+    def cache_footprint(self):
+        """estimate of the memory held by this instance's caches (in bytes)
+
+        Cheap enough to be called on each access: it only sums up sizes
+        tracked as the caches are filled (the caches with variable sized
+        entries keep a running total), apart from the entries of the few
+        history walks."""
+        size = 0
+
+        rev_cache = self.__rev_cache
+        if rev_cache is not None:
+            size += len(rev_cache[2]) * self.__REV_ENTRY_SIZE
+            tips, runs, bounds, containing = rev_cache[8]
+            size += len(runs) * self.__REACH_ENTRY_SIZE + bounds * 4
+            size += containing.footprint()
+
+        ref_cache = self.__ref_cache
+        if ref_cache is not None:
+            size += len(ref_cache[2]) * self.__REF_ENTRY_SIZE
+
+        size += self.__commit_msg_cache.footprint()
+        size += len(self.__fs_obj_size_cache) * self.__OBJ_SIZE_ENTRY_SIZE
+        size += len(self.__blob_probe_cache) * self.__OBJ_SIZE_ENTRY_SIZE
+
+        for walk in self.__history_walks.values():
+            size += len(walk) * self.__HISTORY_ENTRY_SIZE
+
+        rename_index = self.__rename_index
+        if rename_index is not None:
+            size += len(rename_index[2]) * self.__RENAME_ENTRY_SIZE
+
+        return size
+
+    def clear_caches(self):
+        "drop all cached data; caches are refilled on demand"
+        with self.__rev_cache_lock:
+            # a running background rebuild swaps in a fresh snapshot anyway
+            if self.__rev_cache_worker is None:
+                self.__rev_cache = None
+
+        with self.__ref_cache_lock:
+            self.__ref_cache = None
+
+        self.__commit_msg_cache.clear()
+        self.__fs_obj_size_cache.clear()
+        self.__blob_probe_cache.clear()
+        for walk in self.__history_walks.values():
+            walk.close()
+        self.__history_walks.clear()
+
+        with self.__rename_index_lock:
+            self.__rename_index = None
+
     #
     # cache handling
     #
 
     # called by Storage.sync()
-    def __rev_cache_sync(self, youngest_rev=None):
-        "invalidates revision db cache if necessary"
+    def __rev_cache_sync(self, refs_fingerprint):
+        """invalidates revision db cache if necessary; returns whether the
+        revision db visible to callers is expected to change"""
         with self.__rev_cache_lock:
             need_update = False
             if self.__rev_cache:
-                last_youngest_rev = self.__rev_cache[0]
-                if last_youngest_rev != youngest_rev:
-                    self.logger.debug("invalidated caches (%s != %s)" % (last_youngest_rev, youngest_rev))
+                last_refs_fingerprint = self.__rev_cache[6]
+                if last_refs_fingerprint != refs_fingerprint:
+                    self.logger.debug("invalidated caches (%s != %s)" % (last_refs_fingerprint, refs_fingerprint))
                     need_update = True
             else:
                 need_update = True # almost NOOP
 
+            if not self.__rebuild_in_background or not self.__rev_cache:
+                if need_update:
+                    self.__rev_cache = None
+
+                return need_update
+
+            # stale-while-revalidate: keep serving the current snapshot
+            # while a worker thread builds its replacement
             if need_update:
+                self.__rev_cache_target = refs_fingerprint
+                if self.__rev_cache_stale_since is None:
+                    self.__rev_cache_stale_since = time.time()
+                if self.__rev_cache_worker is None:
+                    self.__rev_cache_worker = Thread(target=self.__rev_cache_rebuild_worker)
+                    self.__rev_cache_worker.setDaemon(True)
+                    self.__rev_cache_worker.start()
+
+            swapped = self.__rev_cache_swapped
+            self.__rev_cache_swapped = False
+
+            return swapped
+
+    def __rev_cache_rebuild_worker(self):
+        "background thread replacing the stale revision db snapshot"
+        try:
+            while True:
+                new_rev_cache = self.__rev_cache_build()
+
+                with self.__rev_cache_lock:
+                    # atomically swap in the new snapshot
+                    self.__rev_cache = new_rev_cache
+                    self.__rev_cache_swapped = True
+
+                    # rebuild again if refs changed during the rebuild
+                    if new_rev_cache[6] == self.__rev_cache_target:
+                        self.__rev_cache_stale_since = None
+                        self.__rev_cache_worker = None
+                        break
+        except:
+            self.logger.exception("background rebuild of commit tree db for %d failed" % id(self))
+            with self.__rev_cache_lock:
+                # fall back to a synchronous rebuild on the next access
                 self.__rev_cache = None
+                self.__rev_cache_stale_since = None
+                self.__rev_cache_worker = None
+            return
 
-            return need_update
+        try:
+            self.__rename_index_update(build=False)
+        except:
+            self.logger.exception("updating rename index for %d failed" % id(self))
+
+    # identifies the ordinals of a commit tree db built from scratch;
+    # extending a db keeps them
+    __epochs = count(1)
+
+    # seconds between checks of the spool for new ref updates
+    SPOOL_POLL_INTERVAL = 1.0
+
+    @staticmethod
+    def __spool_consumer(spool):
+        """spool watching thread, shared by the Storage instances using the
+        same spool; ends with the last of them"""
+        while True:
+            time.sleep(Storage.SPOOL_POLL_INTERVAL)
+            if spool.release():
+                return
+            try:
+                updates = spool.poll()
+            except:
+                spool.logger.exception("polling spool '%s' failed" % spool.path)
+                continue
+            if not updates:
+                continue
+
+            # the spool doesn't tell which repository was pushed to;
+            # Storage instances whose refs didn't change return early
+            for storage in spool.storages.values():
+                try:
+                    storage.logger.debug("%d ref updates pushed to %d" % (len(updates), id(storage)))
+                    storage.__apply_ref_updates()
+                except:
+                    storage.logger.exception("applying ref updates to %d failed" % id(storage))
+            storage = None
+
+    def __apply_ref_updates(self):
+        """bring ref cache, commit tree db and rename index up to date with
+        the refs, extending the db by the new commits if possible"""
+        refs_fingerprint = self.__refs.fingerprint()
+        rev_cache = self.__rev_cache
+
+        with self.__ref_cache_lock:
+            old_ref_cache = self.__ref_cache
+            if old_ref_cache is not None and old_ref_cache[0] != refs_fingerprint:
+                self.__ref_cache = None
+
+        if rev_cache is None or rev_cache[6] == refs_fingerprint:
+            return # built on next access, or up to date
+
+        new_ref_cache = self.get_ref_cache()
+
+        new_rev_cache = None
+        if old_ref_cache is not None and old_ref_cache[0] == rev_cache[6]:
+            new_rev_cache = self.__rev_cache_extend(rev_cache, old_ref_cache, new_ref_cache)
+        if new_rev_cache is None:
+            new_rev_cache = self.__rev_cache_build()
 
-    def get_rev_cache(self):
         with self.__rev_cache_lock:
-            if self.__rev_cache is None: # can be cleared by Storage.__rev_cache_sync()
-                self.logger.debug("triggered rebuild of commit tree db for %d" % id(self))
-                new_db = {}
-                new_sdb = {}
-                new_tags = set([])
-                youngest = None
-                oldest = None
-                for revs in self.repo.rev_parse("--tags"):
-                    new_tags.add(revs.strip())
-
-                # helper for reusing strings
-                __rev_seen = {}
-                def __rev_reuse(rev):
-                    rev = str(rev)
-                    return __rev_seen.setdefault(rev, rev)
-
-                rev = ord_rev = 0
-                for revs in self.repo.rev_list("--parents", "--all"):
-                    revs = revs.strip().split()
-
-                    revs = map(__rev_reuse, revs)
-
-                    rev = revs[0]
-
-                    # shortrev "hash" map
-                    srev_key = self.__rev_key(rev)
-                    new_sdb.setdefault(srev_key, []).append(rev)
-
-                    parents = tuple(revs[1:])
-
-                    ord_rev += 1
-
-                    # first rev seen is assumed to be the youngest one (and has ord_rev=1)
-                    if not youngest:
-                        youngest = rev
-
-                    # new_db[rev] = (children(rev), parents(rev), ordinal_id(rev))
-                    if new_db.has_key(rev):
-                        _children,_parents,_ord_rev = new_db[rev]
-                        assert _children
-                        assert not _parents
-                        assert _ord_rev == 0
-                    else:
-                        _children = []
+            # unless cleared or rebuilt meanwhile
+            if self.__rev_cache is rev_cache:
+                self.__rev_cache = new_rev_cache
+                self.__rev_cache_swapped = True
+
+        self.__rename_index_update(build=False)
+
+    def __rev_cache_extend(self, rev_cache, old_ref_cache, new_ref_cache):
+        """extend rev_cache by the commits reachable from the refs in
+        new_ref_cache but not from those in old_ref_cache; returns None if
+        the db needs a rebuild instead, i.e. if commits became unreachable
+        (deleted refs, forced updates) or if the new commits wouldn't all
+        precede the known ones in 'git rev-list' order"""
+        youngest, oldest, db, tag_db, sdb, (ts_keys, ts_revs), _, epoch, reach = rev_cache
+        refs_fingerprint = new_ref_cache[0]
+
+        old_tips = self.__rev_list_tips(old_ref_cache)
+        new_tips = self.__rev_list_tips(new_ref_cache)
+        if old_tips is None or new_tips is None:
+            return None
 
-                    # create/update entry
-                    new_db[rev] = _children, parents, ord_rev
+        dropped = list(self.__iter_rev_list("--max-count=1",
+                                            input=''.join([ '%s\n' % tip for tip in old_tips ] +
+                                                          [ '^%s\n' % tip for tip in new_tips ])))
+        if dropped:
+            return None
 
-                    # update all parents(rev)'s children
-                    for parent in parents:
-                        # by default, a dummy ordinal_id is used for the mean-time
-                        _children, _parents, _ord_rev = new_db.setdefault(parent, ([], [], 0))
-                        if rev not in _children:
-                            _children.append(rev)
+        revs, times, parents = self.__read_rev_list(input=''.join([ '%s\n' % tip for tip in new_tips ] +
+                                                                  [ '^%s\n' % tip for tip in old_tips ]))
+        if revs and ts_keys and min(times) <= ts_keys[-1]:
+            return None
 
-                # last rev seen is assumed to be the oldest one (with highest ord_rev)
-                oldest = rev
+        # new commits get the ordinals preceding the youngest known one
+        first = youngest and db[youngest][2] or 1
+        base = first - len(revs)
+
+        new_children = {}
+        for rev, _parents in zip(revs, parents):
+            for i, parent in enumerate(_parents):
+                if parent not in _parents[:i]:
+                    new_children.setdefault(parent, []).append(rev)
+
+        new_db = dict(db)
+        for i, rev in enumerate(revs):
+            new_db[rev] = tuple(new_children.pop(rev, ())), parents[i], base + i
+        for parent, children in new_children.iteritems():
+            if parent not in db:
+                self.logger.warning("parent %s missing in commit tree db" % parent)
+                return None
+            _children, _parents, ordinal = db[parent]
+            new_db[parent] = tuple(children) + _children, _parents, ordinal
 
-                __rev_seen = None
+        if isinstance(sdb, dict):
+            new_sdb = dict(sdb)
+        else:
+            new_sdb = list(sdb)
+        for rev in reversed(revs):
+            key = self.__rev_key(rev)
+            if isinstance(new_sdb, list) and key >= len(new_sdb):
+                new_sdb.extend([()] * (key + 1 - len(new_sdb)))
+            try:
+                new_sdb[key] = (rev,) + new_sdb[key]
+            except KeyError:
+                new_sdb[key] = (rev,)
 
-                assert len(new_db) == ord_rev
+        order = range(len(revs) - 1, -1, -1)
+        order.sort(key=times.__getitem__)
+        new_timeline = (ts_keys + [ times[i] for i in order ],
+                        ts_revs + [ revs[i] for i in order ])
 
-                # convert children lists to tuples
-                tmp = {}
-                try:
-                    while True:
-                        k,v = new_db.popitem()
-                        assert v[2] > 0
-                        tmp[k] = tuple(v[0]),v[1],v[2]
-                except KeyError:
-                    pass
+        if revs:
+            youngest = revs[0]
+            oldest = oldest or revs[-1]
 
-                assert len(new_db) == 0
-                new_db = tmp
+        # the ordinals are kept, and so are the bitmaps of the known commits
+        new_reach = self.__build_reach_index(new_db, new_ref_cache, reach[1])
 
-                # convert sdb either to dict or array depending on size
-                tmp = [()]*(max(new_sdb.keys())+1) if len(new_sdb) > 5000 else {}
+        self.logger.debug("extended commit tree db for %d by %d entries" % (id(self), len(revs)))
 
-                try:
-                    while True:
-                        k,v = new_sdb.popitem()
-                        tmp[k] = tuple(v)
-                except KeyError:
-                    pass
+        return youngest, oldest, new_db, self.__tag_db(new_ref_cache), new_sdb, new_timeline, \
+            refs_fingerprint, epoch, new_reach
 
-                assert len(new_sdb) == 0
-                new_sdb = tmp
+    # refs_containing() results kept per reachability index
+    __REFS_CONTAINING_CACHE_SIZE = 200
 
-                # atomically update self.__rev_cache
-                self.__rev_cache = youngest, oldest, new_db, new_tags, new_sdb
-                self.logger.debug("rebuilt commit tree db for %d with %d entries" % (id(self),len(new_db)))
+    @staticmethod
+    def __build_reach_index(db, ref_cache, known=None):
+        """reachability index of the refs in ref_cache: tuple of a dict
+        mapping refnames to their (peeled) tip commits, a dict mapping
+        tip commits (and anchors) to the run-length encoded bitmaps of
+        the ordinals of the commits reachable from them, the total number
+        of bitmap bounds and a cache of refs_containing() results; known
+        are bitmaps of a previous index whose db has been extended"""
+        tips = dict((refname, peeled) for refname, (sha, peeled)
+                    in ref_cache[2].iteritems() if peeled in db)
+        runs = _build_reach_runs(db, set(tips.itervalues()), known)
+        return tips, runs, sum(map(len, runs.itervalues())), \
+            LoadingCache(Storage.__REFS_CONTAINING_CACHE_SIZE, sizeof=lambda refnames:
+                         Storage.__REACH_ENTRY_SIZE + len(refnames) * 4)
+
+    @staticmethod
+    def __tag_db(ref_cache):
+        "pre-peeled annotated tags: tag_db[tag object sha] = target sha"
+        return dict((sha, peeled) for sha, peeled in ref_cache[2].itervalues()
+                    if sha != peeled)
+
+    def __rev_cache_build(self):
+        "build revision db from scratch; returns new rev_cache tuple"
+        self.logger.debug("triggered rebuild of commit tree db for %d" % id(self))
+
+        # taken before reading refs, so concurrent ref updates are
+        # detected by the next sync()
+        refs_fingerprint = self.__refs.fingerprint()
 
-            assert all(e is not None for e in self.__rev_cache) or not any(self.__rev_cache)
+        ref_cache = self.get_ref_cache()
+        new_tags = self.__tag_db(ref_cache)
 
-            return self.__rev_cache
+        if self.__ref_filter:
+            revs, times, parents = self.__read_rev_list(input=''.join([ tip + '\n' for tip in
+                                                                       self.__rev_list_tips(ref_cache, True) ]))
+        else:
+            revs, times, parents = self.__read_rev_list("--all")
+
+        youngest, oldest, new_db, new_sdb, new_timeline = _build_rev_db(revs, times, parents)
+        new_reach = self.__build_reach_index(new_db, ref_cache)
+
+        self.logger.debug("rebuilt commit tree db for %d with %d entries" % (id(self),len(new_db)))
+
+        return youngest, oldest, new_db, new_tags, new_sdb, new_timeline, refs_fingerprint, \
+            Storage.__epochs.next(), new_reach
+
+    def __iter_rev_list(self, *args, **kwargs):
+        """run 'git rev-list --parents --timestamp' and yield (timestamp,
+        rev, parents) tuples; an optional 'input' is passed via --stdin"""
+        input = kwargs.get('input')
+        if input is not None:
+            args += ("--stdin",)
+
+        pipe = self.repo.stream("rev-list", "--parents", "--timestamp", *args, **kwargs)
+        try:
+            for line in pipe:
+                revs = line.split()
+                # leading field is the committer timestamp
+                yield int(revs[0]), revs[1], revs[2:]
+        finally:
+            pipe.close()
+
+    def __read_rev_list(self, *args, **kwargs):
+        """run 'git rev-list --parents --timestamp' and return parallel lists
+        (revs, timestamps, parent tuples) in output order; the output is
+        read in large blocks and split in bulk. An optional 'input' is
+        passed via --stdin"""
+        input = kwargs.get('input')
+        if input is not None:
+            args += ("--stdin",)
+
+        revs, times, parents = [], [], []
+        pipe = self.repo.stream("rev-list", "--parents", "--timestamp", *args, **kwargs)
+        try:
+            rest = ''
+            while True:
+                block = pipe.read(0x100000)
+                lines = (rest + block).split('\n')
+                rest = block and lines.pop() or ''
+
+                # lines are '<timestamp> <rev> [<parent>...]'; interning
+                # shares the rev strings between all their occurrences
+                rows = [ line.split(' ') for line in lines if line ]
+                times.extend([ int(row[0]) for row in rows ])
+                revs.extend([ intern(row[1]) for row in rows ])
+                parents.extend([ tuple(map(intern, row[2:])) for row in rows ])
+
+                if not block:
+                    break
+        finally:
+            pipe.close()
+
+        return revs, times, parents
+
+    def __rev_list_tips(self, ref_cache, resolve_head=False):
+        """(peeled) shas of the refs in ref_cache in the order of '--all':
+        refs sorted by name, followed by HEAD. HEAD is always covered,
+        even if its branch is filtered out; as ref_cache doesn't know its
+        sha then, it's resolved if resolve_head is True, else None is
+        returned"""
+        tips = [ ref_cache[2][name][1] for name in sorted(ref_cache[2]) ]
+        head = ref_cache[1]
+        if head and head not in ref_cache[2]:
+            if GitCore.is_sha(head):
+                tips.append(head) # detached HEAD
+            elif not resolve_head:
+                return None
+            else:
+                head = self.repo.rev_parse("--verify", "--quiet", head + "^{commit}").read().strip()
+                if head:
+                    tips.append(head)
+        return tips
+
+    def get_rev_cache(self):
+        rev_cache = self.__rev_cache
+        stale_since = self.__rev_cache_stale_since
+
+        # common case, no locking needed for reading a complete snapshot
+        if rev_cache is not None and \
+                (stale_since is None or time.time() - stale_since < self.__max_staleness):
+            return rev_cache
+
+        with self.__rev_cache_lock:
+            worker = self.__rev_cache_worker
+            if self.__rev_cache is None: # can be cleared by Storage.__rev_cache_sync()
+                # atomically update self.__rev_cache
+                self.__rev_cache = self.__rev_cache_build()
+
+            rev_cache = self.__rev_cache
         # with self.__rev_cache_lock
 
-    # tuple: youngest_rev, oldest_rev, rev_dict, tag_dict, short_rev_dict
+        if worker is not None and rev_cache is not None:
+            # snapshot exceeds maximum staleness, wait for the rebuild
+            worker.join()
+            rev_cache = self.__rev_cache or self.get_rev_cache()
+
+        # an empty repository has neither a youngest nor an oldest rev
+        assert (rev_cache[0] is None) == (rev_cache[1] is None)
+
+        return rev_cache
+
+    # tuple: youngest_rev, oldest_rev, rev_dict, tag_dict, short_rev_dict,
+    #        (sorted commit timestamps, corresponding revs), refs_fingerprint,
+    #        ordinals epoch, reachability index of the refs
     rev_cache = property(get_rev_cache)
 
+    # called by Storage.sync()
+    def __ref_cache_sync(self, refs_fingerprint):
+        "invalidates ref cache if refs changed"
+        with self.__ref_cache_lock:
+            if self.__ref_cache and self.__ref_cache[0] != refs_fingerprint:
+                self.__ref_cache = None
+
+    def get_ref_cache(self):
+        ref_cache = self.__ref_cache
+        if ref_cache is not None:
+            return ref_cache
+
+        with self.__ref_cache_lock:
+            if self.__ref_cache is None: # can be cleared by Storage.__ref_cache_sync()
+                refs_fingerprint = self.__refs.fingerprint()
+
+                head = None
+                try:
+                    f = open(os.path.join(self.__git_dir, 'HEAD'))
+                    try:
+                        head = f.read().strip()
+                    finally:
+                        f.close()
+                    if head.startswith('ref:'):
+                        head = head[4:].strip()
+                except IOError:
+                    pass
+
+                # refs[refname] = (sha, peeled_sha)
+                refs = {}
+                branches = []
+                tags = []
+                for line in self.repo.for_each_ref("--format=%(objectname) %(refname) %(*objectname)"):
+                    sha, refname, peeled = (line.rstrip('\n').split(' ') + [''])[:3]
+                    if self.__ref_filter and not self.__ref_filter(refname):
+                        continue
+                    refs[refname] = sha, peeled or sha
+                    if refname.startswith('refs/heads/'):
+                        branches.append((refname[11:], sha))
+                    elif refname.startswith('refs/tags/'):
+                        tags.append(refname[10:])
+
+                self.__ref_cache = refs_fingerprint, head, refs, branches, tags
+                self.logger.debug("rebuilt ref cache for %d with %d entries" % (id(self), len(refs)))
+
+            return self.__ref_cache
+
+    # tuple: refs_fingerprint, HEAD (refname, or sha if detached),
+    #        refs_dict (refname -> (sha, peeled sha)), branch list, tag list;
+    #        only refs selected by the ref filter are listed
+    ref_cache = property(get_ref_cache)
+
+    def warmup(self, recent_commits=50):
+        """populate caches in advance: commit tree db, refs, the most recent
+        commits and the object sizes of HEAD's root tree"""
+        self.sync()
+        ts_revs = self.rev_cache[5][1]
+        self.get_ref_cache()
+
+        if recent_commits > 0:
+            for rev in reversed(ts_revs[-recent_commits:]):
+                self.read_commit(rev)
+
+        head = self.head()
+        if head:
+            self.ls_tree(head, long=True)
+
     def get_commits(self):
         return self.rev_cache[2]
 
@@ -343,7 +1747,8 @@ class Storage:
         return self.rev_cache[0]
 
     def history_relative_rev(self, sha, rel_pos):
-        db = self.get_commits()
+        rev_cache = self.rev_cache
+        db = rev_cache[2]
 
         if sha not in db:
             raise GitErrorSha
@@ -353,7 +1758,10 @@ class Storage:
 
         lin_rev = db[sha][2] + rel_pos
 
-        if lin_rev < 1 or lin_rev > len(db):
+        # ordinals are consecutive, starting with the youngest rev's one
+        # (which is below 1 after the db got extended by pushed commits)
+        first = db[rev_cache[0]][2]
+        if lin_rev < first or lin_rev >= first + len(db):
             return None
 
         for k,v in db.iteritems():
@@ -380,6 +1788,59 @@ class Storage:
         "get current HEAD commit id"
         return self.verifyrev("HEAD")
 
+    # <refname> with optional '~<n>' and '^<n>' suffixes, e.g. 'HEAD~3^2'
+    __SYMREV_RE = re.compile(r'^([A-Za-z0-9_][A-Za-z0-9_./-]*?)((?:[~^][0-9]*)*)$')
+
+    def __resolve_symbolic_rev(self, rev):
+        """resolve simple symbolic revs from ref cache and commit tree db;
+        returns None if rev needs to be looked up via git"""
+        m = self.__SYMREV_RE.match(rev)
+        if not m or '..' in rev:
+            return None
+        name, suffixes = m.groups()
+
+        head, refs = self.ref_cache[1:3]
+
+        if name == 'HEAD':
+            sha = head
+            if head in refs:
+                sha = refs[head][1]
+        elif name.isupper():
+            # $GIT_DIR/<name> (e.g. ORIG_HEAD) takes precedence, let git decide
+            return None
+        else:
+            # same lookup order as git-rev-parse(1)
+            for refname in ('refs/%s', 'refs/tags/%s', 'refs/heads/%s',
+                            'refs/remotes/%s', 'refs/remotes/%s/HEAD'):
+                refname = refname % name
+                if refname in refs:
+                    sha = refs[refname][1]
+                    break
+            else:
+                return None
+
+        db = self.get_commits()
+        if sha not in db:
+            return None
+
+        for suffix in re.findall(r'[~^][0-9]*', suffixes):
+            n = int(suffix[1:] or 1)
+            if suffix[0] == '~':
+                # n-th generation ancestor, following first parents
+                for i in xrange(n):
+                    parents = db[sha][1]
+                    if not parents:
+                        return ''
+                    sha = parents[0]
+            elif n:
+                # n-th parent
+                parents = db[sha][1]
+                if n > len(parents):
+                    return ''
+                sha = parents[n-1]
+
+        return sha
+
     def verifyrev(self, rev):
         "verify/lookup given revision object and return a sha id or None if lookup failed"
         rev = str(rev)
@@ -392,6 +1853,11 @@ class Storage:
             if fullrev:
                 return fullrev
 
+        # resolve branch/tag names and suffixes from memory if possible
+        sha = self.__resolve_symbolic_rev(rev)
+        if sha is not None:
+            return sha or None
+
         # fall back to external git calls
         rc = self.repo.rev_parse("--verify", rev).read().strip()
         if not rc:
@@ -401,11 +1867,7 @@ class Storage:
             return rc
 
         if rc in tag_db:
-            sha=self.repo.cat_file("tag", rc).read().split(None, 2)[:2]
-            if sha[0] != 'object':
-                self.logger.debug("unexpected result from 'git-cat-file tag %s'" % rc)
-                return None
-            return sha[1]
+            return tag_db[rc]
 
         return None
 
@@ -465,27 +1927,31 @@ class Storage:
 
     def get_branches(self):
         "returns list of (local) branches, with active (= HEAD) one being the first item"
-        result=[]
-        for e in self.repo.branch("-v", "--no-abbrev"):
-            (bname,bsha)=e[1:].strip().split()[:2]
-            if e.startswith('*'):
-                result.insert(0,(bname,bsha))
-            else:
-                result.append((bname,bsha))
+        head_ref, refs, branches = self.ref_cache[1:4]
+        result = list(branches)
+        if head_ref and head_ref.startswith('refs/heads/') and head_ref in refs:
+            head_branch = (head_ref[11:], refs[head_ref][0])
+            result.remove(head_branch)
+            result.insert(0, head_branch)
         return result
 
     def get_tags(self):
-        return [e.strip() for e in self.repo.tag("-l")]
+        return list(self.ref_cache[4])
 
-    def ls_tree(self, rev, path=""):
+    def ls_tree(self, rev, path="", long=False, recursive=False):
+        """list tree entries as (mode, type, sha, fname) tuples; with
+        long=True, the object size (None for non-blobs) is appended; with
+        recursive=True, the blobs of all subtrees are listed instead"""
         rev = str(rev) # paranoia
         if path.startswith('/'):
             path = path[1:]
 
+        args = long and ["-z", "-l", rev] or ["-z", rev]
+        if recursive:
+            args.insert(0, "-r")
         if path:
-            tree = self.repo.ls_tree("-z", rev, "--", path)
-        else:
-            tree = self.repo.ls_tree("-z", rev)
+            args += ["--", path]
+        tree = self.repo.ls_tree(*args)
 
         def split_ls_tree_line(l):
             "split according to '<mode> <type> <sha>\t<fname>'"
@@ -493,9 +1959,30 @@ class Storage:
             _mode,_type,_sha = meta.split(' ')
             return _mode,_type,_sha,fname
 
-        return [split_ls_tree_line(e) for e in tree.read().split('\0') if e]
+        def split_ls_tree_long_line(l):
+            "split according to '<mode> <type> <sha> <size>\t<fname>'"
+            meta,fname = l.split('\t')
+            _mode,_type,_sha,_size = meta.split(None, 3)
+            if _size == '-':
+                _size = None
+            else:
+                _size = int(_size)
+            return _mode,_type,_sha,fname,_size
+
+        if not long:
+            return [split_ls_tree_line(e) for e in tree.read().split('\0') if e]
+
+        entries = [split_ls_tree_long_line(e) for e in tree.read().split('\0') if e]
+
+        # sizes come for free, remember them
+        for _mode,_type,_sha,fname,_size in entries:
+            if _size is not None:
+                self.__fs_obj_size_cache.put(_sha, _size)
+
+        return entries
 
     def read_commit(self, commit_id):
+        "return Commit record of commit_id (shared with the cache)"
         if not commit_id:
             raise GitError("read_commit called with empty commit_id")
 
@@ -506,49 +1993,237 @@ class Storage:
             self.logger.info("read_commit failed for '%s'" % commit_id)
             raise GitErrorSha
 
-        with self.__commit_msg_lock:
-            if self.__commit_msg_cache.has_key(commit_id):
-                # cache hit
-                result = self.__commit_msg_cache[commit_id]
-                return result[0], dict(result[1])
+        return self.__commit_msg_cache.get(commit_id, self.__load_commit)
 
-            # cache miss
-            raw = self.repo.cat_file("commit", commit_id).read()
-            raw = unicode(raw, self.get_commit_encoding(), 'replace')
-            lines = raw.splitlines()
+    def __load_commit(self, commit_id):
+        return self.__parse_commit(self.repo.cat_file("commit", commit_id).read())
 
-            if not lines:
-                raise GitErrorSha
+    def __parse_commit(self, raw):
+        "parse raw commit object into Commit record"
+        return Commit.parse(raw, self.get_commit_encoding())
 
-            line = lines.pop(0)
-            props = {}
-            while line:
-                (key,value) = line.split(None, 1)
-                props.setdefault(key,[]).append(value.strip())
-                line = lines.pop(0)
+    def __new_revs_walk_input(self, known_revs):
+        """return '--stdin' input for 'git log'/'git rev-list' limiting the
+        walk to the commits not contained in known_revs (or None if there
+        are no such commits)"""
+        db = self.get_commits()
+        new_revs = [ rev for rev in db if rev not in known_revs ]
+        if not new_revs:
+            return None
+
+        # walk from the tips of the new revs and stop at already known ones
+        new_revs_set = set(new_revs)
+        tips = [ rev for rev in new_revs
+                 if not new_revs_set.intersection(db[rev][0]) ]
+        boundary = set(parent for rev in new_revs for parent in db[rev][1]
+                       if parent not in new_revs_set)
+        return "".join([ rev + "\n" for rev in tips ] +
+                       [ "^" + rev + "\n" for rev in boundary ])
+
+    def log_changes(self, known_revs):
+        """stream all commits not contained in known_revs in topological
+        order (parents before children) from a single `git log --raw`
+        pipeline; yields (sha, commit, changes) tuples, where commit is a
+        Commit record and changes
+        is a list of (parent, diff records) pairs with diff records as
+        returned by diff_tree(find_renames=True)"""
+
+        walk_input = self.__new_revs_walk_input(known_revs)
+        if walk_input is None:
+            return
+
+        # 'git log -z --raw' emits, separated by NULs, a header (raw commit
+        # prefixed by 'commit <sha>[ (from <parent>)]' with an indented
+        # message) which may have the first diff record appended after an
+        # empty line, followed by one or two path fields per diff record;
+        # merges are repeated once per parent due to '-m'
+        log = self.repo.stream("log", "--stdin", "-z", "--raw", "-m", "-M",
+                               "--no-abbrev", "--pretty=raw",
+                               "--topo-order", "--reverse",
+                               input=walk_input)
+
+        def __parse_header(header):
+            lines = header.split('\n')
+            # undo the message indentation of '--pretty=raw'
+            while lines and not lines[-1]:
+                lines.pop()
+            lines = [ l[4:] if l.startswith('    ') else l for l in lines[1:] ]
+            return self.__parse_commit("\n".join(lines))
+
+        commit = None # [sha, Commit, changes]
+        chg = None
 
-            result = ("\n".join(lines), props)
+        try:
+            for token in _iter_nul_tokens(log):
+                if chg is not None:
+                    # collect path field(s) of current diff record
+                    chg.append(token)
+                    if len(chg) == 7 or chg[4][0] not in 'RC':
+                        if len(chg) == 6:
+                            chg.append(None)
+                        commit[2][-1][1].append(tuple(chg))
+                        chg = None
+                    continue
+
+                token = token.lstrip('\n')
+                if not token:
+                    continue
+
+                if token.startswith('commit '):
+                    header, record = token, None
+                    idx = token.find('\n:')
+                    if idx >= 0:
+                        header, record = token[:idx], token[idx+1:]
+
+                    fields = header.split('\n', 1)[0].split()
+                    sha = fields[1]
+                    if commit is None or commit[0] != sha:
+                        if commit is not None:
+                            yield tuple(commit)
+                        commit = [sha, __parse_header(header), []]
+
+                    if len(fields) > 2: # 'commit <sha> (from <parent>)'
+                        parent = fields[3].rstrip(')')
+                    else:
+                        parent = (commit[1].parents or [None])[0]
+                    commit[2].append((parent, []))
 
-            self.__commit_msg_cache[commit_id] = result
+                    if record:
+                        chg = record[1:].split()
+                elif token.startswith(':'):
+                    chg = token[1:].split()
+                else:
+                    raise GitError("unexpected 'git log' output")
 
-            return result[0], dict(result[1])
+            if commit is not None:
+                yield tuple(commit)
+        finally:
+            log.close()
 
     def get_file(self, sha):
         return self.repo.cat_file("blob", str(sha))
 
+    def iter_blobs(self, shas):
+        """yield (sha, content) for several blobs, read by a single
+        'git cat-file --batch'; unknown objects are skipped"""
+        pipe = self.repo.stream("cat-file", "--batch",
+                                input=''.join([ '%s\n' % sha for sha in shas ]))
+        try:
+            while True:
+                # '<sha> <type> <size>' or '<object> missing'
+                header = pipe.readline()
+                if not header:
+                    break
+                fields = header.split()
+                if len(fields) != 3:
+                    continue
+                content = pipe.read(int(fields[2]))
+                pipe.read(1) # trailing LF
+                yield fields[0], content
+        finally:
+            pipe.close()
+
+    def grep(self, rev, patterns, paths=None, ignore_case=True):
+        """search the text blobs of rev for files containing all of the
+        fixed strings in patterns (optionally limited to paths); yields
+        (path, lineno, line) for each line containing any of them"""
+        rev = str(rev)
+        args = ["-z", "-n", "-I", "-F", "--all-match"]
+        if ignore_case:
+            args.append("-i")
+        for pattern in patterns:
+            args += ["-e", pattern]
+        args.append(rev)
+
+        # long path lists are split up, to stay within command line limits
+        chunks = [None]
+        if paths:
+            chunks = [ paths[i:i+500] for i in xrange(0, len(paths), 500) ]
+
+        for chunk in chunks:
+            pipe = self.repo.stream("grep", *(chunk and args + ["--"] + chunk or args))
+            try:
+                # '<rev>:<path> NUL <lineno> NUL <line>'
+                for line in pipe:
+                    fields = line.rstrip('\n').split('\0', 2)
+                    if len(fields) == 3:
+                        yield fields[0][len(rev)+1:], int(fields[1]), fields[2]
+            finally:
+                pipe.close()
+
+    def get_file_stream(self, sha):
+        """like get_file(), but returns a GitPipe reading the blob from
+        git while it is consumed, instead of buffering it as a whole"""
+        return self.repo.stream("cat-file", "blob", str(sha))
+
+    # git itself considers blobs with a NUL in their first 8000 bytes binary
+    BLOB_PROBE_SIZE = 8000
+
+    def probe_blob(self, sha):
+        """classify blob by its leading bytes without reading it as a whole;
+        returns (size, is_binary)
+
+        Size and leading bytes are read by a single 'git cat-file --batch'
+        and the result is cached per sha."""
+        return self.__blob_probe_cache.get(str(sha), self.__load_blob_probe)
+
+    def __load_blob_probe(self, sha):
+        pipe = self.repo.stream("cat-file", "--batch", input=sha + '\n')
+        try:
+            # '<sha> <type> <size>' or '<object> missing'
+            fields = pipe.readline().split()
+            if len(fields) != 3:
+                raise GitErrorSha("object '%s' not found" % sha)
+            size = int(fields[2])
+            head = pipe.read(min(size, self.BLOB_PROBE_SIZE))
+        finally:
+            pipe.close() # git gets terminated by SIGPIPE if there is more
+
+        self.__fs_obj_size_cache.put(sha, size)
+        return (size, '\0' in head)
+
     def get_obj_size(self, sha):
-        sha = str(sha)
+        return self.__fs_obj_size_cache.get(str(sha), self.__load_obj_size)
+
+    def __load_obj_size(self, sha):
         try:
-            with self.__fs_obj_size_lock:
-                if self.__fs_obj_size_cache.has_key(sha):
-                    obj_size = self.__fs_obj_size_cache[sha]
-                else:
-                    obj_size = int(self.repo.cat_file("-s", sha).read().strip())
-                    self.__fs_obj_size_cache[sha] = obj_size
+            return int(self.repo.cat_file("-s", sha).read().strip())
         except ValueError:
             raise GitErrorSha("object '%s' not found" % sha)
 
-        return obj_size
+    def get_obj_sizes(self, shas):
+        """look up the sizes of several objects at once, using a single
+        'git cat-file --batch-check' for the ones not cached yet; returns
+        dict mapping sha to size (unknown objects are left out)"""
+        shas = map(str, shas)
+        result = {}
+        missing = []
+        for sha in shas:
+            size = self.__fs_obj_size_cache.lookup(sha)
+            if size is not None:
+                result[sha] = size
+            else:
+                missing.append(sha)
+
+        if not missing:
+            return result
+
+        # output lines are '<sha> <type> <size>' or '<object> missing'
+        sizes = {}
+        pipe = self.repo.stream("cat-file", "--batch-check", input=''.join([ sha + '\n' for sha in missing ]))
+        try:
+            for line in pipe:
+                fields = line.split()
+                if len(fields) == 3:
+                    sizes[fields[0]] = int(fields[2])
+        finally:
+            pipe.close()
+
+        for sha, size in sizes.iteritems():
+            self.__fs_obj_size_cache.put(sha, size)
+
+        result.update(sizes)
+        return result
 
     def children(self, sha):
         db = self.get_commits()
@@ -590,26 +2265,298 @@ class Storage:
         return self.get_commits().iterkeys()
 
     def sync(self):
-        rev = self.repo.rev_list("--max-count=1", "--all").read().strip()
-        return self.__rev_cache_sync(rev)
+        if self.__spool is not None:
+            # ref changes are usually applied by the spool consumer; those
+            # not passing the post-receive hook (or not consumed yet) are
+            # still detected by the fingerprint of the refs
+            self.__apply_ref_updates()
+            with self.__rev_cache_lock:
+                changed = self.__rev_cache_swapped or self.__rev_cache is None
+                self.__rev_cache_swapped = False
+            return changed
+
+        refs_fingerprint = self.__refs.fingerprint()
+        self.__ref_cache_sync(refs_fingerprint)
+        changed = self.__rev_cache_sync(refs_fingerprint)
+
+        # the background rebuild worker updates the rename index itself
+        if not self.__rebuild_in_background:
+            self.__rename_index_update(build=False)
+
+        return changed
 
     def last_change(self, sha, path):
         return self.repo.rev_list("--max-count=1",
                                   sha, "--", path).read().strip() or None
 
-    def history(self, sha, path, limit=None):
-        if limit is None:
-            limit = -1
-        for rev in self.repo.rev_list("--max-count=%d" % limit,
-                                      str(sha), "--", path):
-            yield rev.strip()
+    def last_changes(self, sha, paths):
+        """batched last_change() for many paths; returns dict mapping path
+        to rev (None if path doesn't exist)
+
+        All paths are resolved by a single walk, replaying the history
+        simplification of 'rev-list -- <path>' for each of them: the
+        simplified history of a path is a chain of commits, following the
+        first parent a merge doesn't change the path relative to, and the
+        last change is the first commit on it changing the path.
+        'git log -m --full-history --sparse' lists all commits along with
+        their changes relative to each parent, so the chains of all paths
+        are advanced together and the walk stops once each of them has
+        been resolved."""
+        sha = str(sha)
+        result = dict.fromkeys(paths)
+        if not paths:
+            return result
+
+        # commit -> paths whose chain has reached it
+        waiting = {sha: list(paths)}
+        # commit -> (parents, dict mapping parent to changed paths and
+        # their directories); date order may list a commit before all of
+        # its children, so chains can reach commits already listed
+        seen = {}
+
+        def __touched(names):
+            "names along with all their parent directories"
+            touched = set()
+            for name in names:
+                while name and name not in touched:
+                    touched.add(name)
+                    name = name.rpartition('/')[0]
+            return touched
+
+        def __advance(path, rev):
+            "follow the chain of path from rev as far as listed yet"
+            while rev in seen:
+                parents, touched = seen[rev]
+                if not parents: # root commit, changes are relative to the empty tree
+                    if path in touched.get(None, ()):
+                        result[path] = rev
+                    return
+                for parent in parents:
+                    if path not in touched.get(parent, ()):
+                        rev = parent
+                        break
+                else:
+                    result[path] = rev # changed relative to all parents
+                    return
+            waiting.setdefault(rev, []).append(path)
+
+        def __resolve(rev, parents, changes):
+            seen[rev] = parents, dict((parent, __touched(names))
+                                      for parent, names in changes.iteritems())
+            for path in waiting.pop(rev, ()):
+                __advance(path, rev)
+
+        # paths are passed on stdin, as there may be too many for argv
+        log = self.repo.stream("log", "--stdin", "-z", "-m", "--full-history", "--sparse",
+                               "--root", "--parents", "--raw", "--no-abbrev", "--pretty=oneline",
+                               input=''.join([ '%s\n--\n' % sha ] + [ '%s\n' % path for path in paths ]))
+        try:
+            rev, parents, changes, names = None, None, {}, None
+            expect_path = False
+            for token in _iter_nul_tokens(log):
+                token = token.lstrip('\n')
+                if expect_path:
+                    names.append(token)
+                    expect_path = False
+                    continue
+                if token.startswith(':'):
+                    expect_path = True # raw record, followed by the path
+                    continue
+                if not token:
+                    continue
+
+                # '<sha> <parent>... [(from <parent>)] <subject>'
+                fields = token.split(' ')
+                n = 0
+                while n < len(fields) and len(fields[n]) == 40 and GitCore.is_sha(fields[n]):
+                    n += 1
+                if fields[0] != rev:
+                    if rev is not None:
+                        __resolve(rev, parents, changes)
+                        if not waiting:
+                            break
+                    rev, parents, changes = fields[0], fields[1:n], {}
+
+                parent = len(parents) == 1 and parents[0] or None
+                if len(parents) > 1 and fields[n:n+1] == ['(from']:
+                    parent = fields[n+1].rstrip(')')
+                names = changes.setdefault(parent, [])
+            else:
+                if rev is not None:
+                    __resolve(rev, parents, changes)
+        finally:
+            log.close()
+
+        return result
+
+    # seconds after which the git process of an unused history walk is stopped
+    HISTORY_WALK_IDLE_TIMEOUT = 60
+
+    def history_walk(self, sha, path, follow=False):
+        "return (cached) HistoryWalk for path starting at commit sha"
+        idle_since = time.time() - self.HISTORY_WALK_IDLE_TIMEOUT
+        for walk in self.__history_walks.values():
+            if walk.last_used < idle_since:
+                walk.close()
+
+        return self.__history_walks.get((str(sha), path, follow),
+                                        lambda key: HistoryWalk(self.repo, *key))
+
+    def history(self, sha, path, limit=None, offset=0):
+        return self.history_walk(sha, path).revs(offset, limit)
+
+    def get_rename_index(self):
+        """return dict mapping commit sha to tuple of (old_path, new_path)
+        renames relative to its first parent; built here on first use,
+        then extended over new revisions by sync() (or the spool
+        consumer)"""
+        index = self.__rename_index
+        if index is None:
+            self.__rename_index_update()
+            index = self.__rename_index
+        return index[2]
+
+    def __rename_index_update(self, build=True):
+        """extend the rename index by the commits reachable from the
+        current refs but not from the tips it was last updated for; if
+        there's no index yet, it's only built if build is set
+
+        The dict of renames is only ever added to (entries of commits
+        which became unreachable are harmless), so it's extended in place
+        while readers keep using it."""
+        index = self.__rename_index
+        if index is None and not build:
+            return
+        ref_cache = self.get_ref_cache()
+        if index is not None and index[0] == ref_cache[0]:
+            return
+
+        with self.__rename_index_lock:
+            if self.__rename_index is None:
+                if not build:
+                    return
+                old_tips, renames = [], {}
+            else:
+                if self.__rename_index[0] == ref_cache[0]:
+                    return
+                old_tips, renames = self.__rename_index[1:3]
+
+            tips = self.__rev_list_tips(ref_cache, True)
+            known = set(old_tips)
+            new_tips = [ tip for tip in tips if tip not in known ]
+            if new_tips:
+                self.logger.debug("updating rename index for %d" % id(self))
+
+                # only non-merge commits are considered, as a path-limited
+                # history starts at the commit creating the path, which is
+                # (save for evil merges) never a merge
+                walk_input = ''.join([ '%s\n' % tip for tip in new_tips ] +
+                                     [ '^%s\n' % tip for tip in old_tips ])
+                log = self.repo.stream("log", "--stdin", "--ignore-missing", "-z",
+                                       "--raw", "-M", "--diff-filter=R", "--no-abbrev",
+                                       "--format=%x01%H", input=walk_input)
+                rev, events, fields = None, [], None
+                try:
+                    for token in _iter_nul_tokens(log):
+                        token = token.lstrip('\n')
+                        if fields is not None:
+                            # collect old and new path of rename record
+                            fields.append(token)
+                            if len(fields) == 2:
+                                events.append(tuple(fields))
+                                fields = None
+                        elif token.startswith('\x01'):
+                            if events:
+                                renames[rev] = tuple(events)
+                            rev, events = token[1:], []
+                        elif token.startswith(':'):
+                            fields = []
+                    if events:
+                        renames[rev] = tuple(events)
+                finally:
+                    log.close()
+
+            self.__rename_index = ref_cache[0], tips, renames
+
+    def get_reach_index(self):
+        """return (db, tips, runs) with the commit tree db the index refers
+        to, a dict mapping refnames to their (peeled) tip commits and a
+        dict mapping tip commits to the run-length encoded bitmaps of the
+        ordinals of the commits reachable from them; the index is part of
+        the rev cache, i.e. built and extended along with the db"""
+        rev_cache = self.rev_cache
+        tips, runs = rev_cache[8][:2]
+        return rev_cache[2], tips, runs
+
+    def refs_containing(self, sha):
+        "return sorted list of the refs from which commit sha is reachable"
+        rev_cache = self.rev_cache
+        db = rev_cache[2]
+        tips, runs, bounds, containing = rev_cache[8]
+
+        sha = str(sha)
+        if sha not in db:
+            return []
+
+        def __refs_containing(sha):
+            ordinal = db[sha][2]
+            contained = {}
+            result = []
+            for refname, tip in tips.iteritems():
+                hit = contained.get(tip)
+                if hit is None:
+                    hit = contained[tip] = bisect_right(runs[tip], ordinal) & 1
+                if hit:
+                    result.append(refname)
+            result.sort()
+            return tuple(result)
+
+        return list(containing.get(sha, __refs_containing))
+
+    def rename_source(self, rev, path):
+        """if path was created in commit rev by renaming a file or directory
+        of rev's first parent, return (parent, old_path); else None"""
+        events = self.get_rename_index().get(str(rev))
+        if not events:
+            return None
+
+        path = path.strip('/')
+        parent = self.parents(rev)[0]
+
+        for old_path, new_path in events:
+            if new_path == path:
+                return parent, old_path
+
+        # directories: derive old name from the files moved along
+        prefix = path + '/'
+        old_dirs = set()
+        for old_path, new_path in events:
+            if new_path.startswith(prefix):
+                suffix = new_path[len(path):]
+                if old_path.endswith(suffix) and len(old_path) > len(suffix):
+                    old_dirs.add(old_path[:-len(suffix)])
+
+        if len(old_dirs) == 1:
+            return parent, old_dirs.pop()
+
+        return None
+
+    def history_page(self, sha, path, cursor=0, limit=100, follow=False):
+        """return one page of (rev, path) history entries together with the
+        cursor for the next page (None if this is the last page)"""
+        walk = self.history_walk(sha, path, follow)
+        entries = walk.entries(cursor, limit)
+        next_cursor = cursor + len(entries)
+        if not entries or walk.is_last(next_cursor - 1):
+            next_cursor = None
+        return entries, next_cursor
 
     def history_timerange(self, start, stop):
-        for rev in self.repo.rev_list("--reverse",
-                                      "--max-age=%d" % start,
-                                      "--min-age=%d" % stop,
-                                      "--all"):
-            yield rev.strip()
+        "return revs with committer timestamp within [start, stop], oldest first"
+        ts_keys, ts_revs = self.rev_cache[5]
+
+        # same bounds as 'rev-list --max-age=start --min-age=stop'
+        return ts_revs[bisect_left(ts_keys, start):bisect_right(ts_keys, stop)]
 
     def rev_is_anchestor_of(self, rev1, rev2):
         """return True if rev2 is successor of rev1"""
@@ -617,6 +2564,16 @@ class Storage:
         rev2 = rev2.strip()
         return rev2 in self.children_recursive(rev1)
 
+    def archive(self, treeish, format='tar.gz', prefix=None):
+        """stream 'git archive' output for treeish (commit, tag or tree sha)
+        in the given format ('tar', 'tar.gz' or 'zip') as GitPipe; paths
+        get prefix prepended, if given"""
+        args = ["--format=%s" % format]
+        if prefix:
+            args.append("--prefix=%s" % prefix)
+        args.append(str(treeish))
+        return self.repo.stream("archive", *args)
+
     def blame(self, commit_sha, path):
         in_metadata = False
 
@@ -637,6 +2594,97 @@ class Storage:
 
         assert not in_metadata
 
+    __HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+    # lines per hunk yielded for added/removed blobs
+    __BLOB_HUNK_LINES = 1000
+
+    def diff_blobs(self, old_sha, new_sha, context=3, max_bytes=None):
+        """stream the differences between two blobs as hunks, i.e. tuples
+        (old_start, old_count, new_start, new_count, lines) with lines
+        being the patch lines (prefixed by ' ', '-', '+' or '\\'); either
+        sha may be None for added/removed files, whose lines are yielded
+        as consecutive hunks of bounded size. Binary blobs yield no
+        hunks. Raises GitDiffTooLarge after more than max_bytes of patch
+        output have been read."""
+
+        if old_sha is None or new_sha is None:
+            # git can't diff against a non-existing blob, and the result
+            # is trivial anyway: every line of the blob added or removed
+            sha, prefix = new_sha is None and (old_sha, '-') or (new_sha, '+')
+            if sha is None:
+                return
+            pipe = self.repo.stream("cat-file", "blob", str(sha))
+            try:
+                nbytes = offset = 0
+                lineno = 1
+                lines = []
+                for line in pipe:
+                    # like git, only look for NULs at the start of the blob
+                    if offset < self.BLOB_PROBE_SIZE and \
+                            '\0' in line[:self.BLOB_PROBE_SIZE - offset]:
+                        return # binary
+                    offset += len(line)
+
+                    if line.endswith('\n'):
+                        lines.append(prefix + line[:-1])
+                        nbytes += len(line) + 1
+                    else:
+                        lines.append(prefix + line)
+                        lines.append('\\ No newline at end of file')
+                        nbytes += len(line) + 2 + len(lines[-1]) + 1
+                    if max_bytes is not None and nbytes > max_bytes:
+                        raise GitDiffTooLarge("diff of %s exceeds %d bytes" % (sha, max_bytes))
+
+                    if len(lines) >= self.__BLOB_HUNK_LINES and offset >= self.BLOB_PROBE_SIZE:
+                        hunk = self.__blob_hunk(prefix, lineno, lines)
+                        yield hunk
+                        lineno += hunk[1] + hunk[3]
+                        lines = []
+            finally:
+                pipe.close()
+
+            if lines:
+                yield self.__blob_hunk(prefix, lineno, lines)
+            return
+
+        pipe = self.repo.stream("diff", "--no-color", "--no-ext-diff",
+                                "-U%d" % context, str(old_sha), str(new_sha))
+        try:
+            nbytes = 0
+            hunk = None
+            for line in pipe:
+                nbytes += len(line)
+                if max_bytes is not None and nbytes > max_bytes:
+                    raise GitDiffTooLarge("diff of %s..%s exceeds %d bytes"
+                                          % (old_sha, new_sha, max_bytes))
+                line = line.rstrip('\n')
+
+                m = self.__HUNK_RE.match(line)
+                if m:
+                    if hunk:
+                        yield hunk
+                    a, b, c, d = m.groups()
+                    hunk = (int(a), b is None and 1 or int(b),
+                            int(c), d is None and 1 or int(d), [])
+                elif hunk:
+                    hunk[4].append(line)
+                # else: still in the patch header
+
+            if hunk:
+                yield hunk
+        finally:
+            pipe.close()
+
+    @staticmethod
+    def __blob_hunk(prefix, start, lines):
+        "hunk of the lines of an added (prefix '+') or removed blob"
+        count = len([ l for l in lines if l[0] != '\\' ])
+        if prefix == '+':
+            return (0, 0, start, count, lines)
+        else:
+            return (start, count, 0, 0, lines)
+
     def diff_tree(self, tree1, tree2, path="", find_renames=False):
         """calls `git diff-tree` and returns tuples of the kind
         (mode1,mode2,obj1,obj2,action,path1,path2)"""
@@ -648,8 +2696,10 @@ class Storage:
         if find_renames:
             diff_tree_args.append("-M")
         diff_tree_args.extend([str(tree1) if tree1 else "--root",
-                               str(tree2),
-                               "--", path])
+                               str(tree2)])
+        if path:
+            # an empty pathspec is rejected by git >= 2.16
+            diff_tree_args.extend(["--", path])
 
         lines = self.repo.diff_tree(*diff_tree_args).read().split('\0')
 
@@ -724,6 +2774,28 @@ if __name__ == '__main__':
 
     print_data_usage()
 
+    if sys.argv[1] == '--bench-rev-db':
+        # build time and memory of the commit tree db for a synthetic
+        # graph (default 1M commits, every 5th a merge)
+        import random, resource
+        count = int((sys.argv[2:] or [1000000])[0])
+        random.seed(0)
+        revs = [ intern(sha1(str(i)).hexdigest()) for i in xrange(count) ]
+        times = [ 1200000000 + count - i + random.randint(-100, 100) for i in xrange(count) ]
+        parents = []
+        for i in xrange(count):
+            later = range(i + 1, min(count, i + 50))
+            parents.append(tuple([ revs[j] for j in random.sample(later, min(len(later), 1 + (i % 5 == 0))) ]))
+        print "generated %d commits" % count
+        print_data_usage()
+
+        t0 = time.time()
+        db = _build_rev_db(revs, times, parents)
+        print "built commit tree db in %.2f sec" % (time.time() - t0)
+        print_data_usage()
+        print "peak RSS: %d MiB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+        sys.exit(0)
+
     g = Storage(sys.argv[1], logging)
 
     print_data_usage()
@@ -814,3 +2886,29 @@ if __name__ == '__main__':
     g3 = Storage(sys.argv[1], logging)
     g3.head()
     print_data_usage()
+
+    # concurrent cache misses shouldn't serialize behind a single git call
+    print "--------------"
+    stress_revs = g.get_commits().keys()[:400]
+    stress_blobs = [ sha for mode,type,sha,name in g.ls_tree(g.head()) if type == "blob" ]
+
+    def stress(nthreads):
+        def worker(idx):
+            for rev in stress_revs[idx::nthreads] + stress_revs[:20]:
+                g.read_commit(rev)
+            for sha in stress_blobs:
+                g.get_obj_size(sha)
+
+        g.clear_caches()
+        g.get_commits()
+        threads = [ Thread(target=worker, args=(i,)) for i in range(nthreads) ]
+        t0 = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.time() - t0
+
+    for nthreads in (1, 4, 8):
+        print "stress test with %d thread(s): %.2f sec for %d commits" \
+              % (nthreads, stress(nthreads), len(stress_revs))
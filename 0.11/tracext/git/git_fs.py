@@ -18,43 +18,176 @@ from trac.util.datefmt import FixedOffset, to_timestamp
 from trac.versioncontrol.api import \
     Changeset, Node, Repository, IRepositoryConnector, NoSuchChangeset, NoSuchNode
 from trac.wiki import IWikiSyntaxProvider
-from trac.versioncontrol.cache import CachedRepository
+from trac.versioncontrol.cache import CachedRepository, _kindmap, _actionmap, \
+    CACHE_REPOSITORY_DIR, CACHE_YOUNGEST_REV
 from trac.versioncontrol.web_ui import IPropertyRenderer
-from trac.config import BoolOption, IntOption, PathOption, Option
+from trac.admin import IAdminPanelProvider
+from trac.web.chrome import ITemplateProvider, add_link
+from trac.web.api import IRequestHandler, IRequestFilter, RequestDone, \
+    HTTPServiceUnavailable
+from trac.config import BoolOption, IntOption, PathOption, ListOption, Option
 
 # for some reason CachedRepository doesn't pass-through short_rev()s
 class CachedRepository2(CachedRepository):
+	def __init__(self, db, repos, authz, log, sync_batch=100):
+		self.sync_batch = max(1, sync_batch)
+		CachedRepository.__init__(self, db, repos, authz, log)
+
 	def short_rev(self, path):
 		return self.repos.short_rev(path)
 
+	def sync(self, feedback=None):
+		"""git-specific replacement for CachedRepository.sync(), which
+		streams all not yet cached commits together with their changes
+		from a single 'git log' pipeline and stores them in batches
+
+		Each batch is committed together with the 'youngest_rev'
+		metadata, so an interrupted sync resumes with the commits
+		missing from the 'revision' table."""
+		db = self.getdb()
+		cursor = db.cursor()
+		cursor.execute("SELECT name, value FROM system WHERE name IN (%s,%s)",
+			       (CACHE_REPOSITORY_DIR, CACHE_YOUNGEST_REV))
+		metadata = dict(cursor)
+
+		# -- check that we're populating the cache for the correct repository
+		repository_dir = metadata.get(CACHE_REPOSITORY_DIR)
+		if repository_dir:
+			if os.path.normcase(repository_dir) != os.path.normcase(self.name):
+				self.log.info("'repository_dir' has changed from %r to %r"
+					      % (repository_dir, self.name))
+				raise TracError("The 'repository_dir' has changed, a "
+						"'trac-admin resync' operation is needed.")
+		elif repository_dir is None:
+			self.log.info('Storing initial "repository_dir": %s' % self.name)
+			cursor.execute("INSERT INTO system (name,value) VALUES (%s,%s)",
+				       (CACHE_REPOSITORY_DIR, self.name))
+		else: # 'repository_dir' cleared by a resync
+			self.log.info('Resetting "repository_dir": %s' % self.name)
+			cursor.execute("UPDATE system SET value=%s WHERE name=%s",
+				       (self.name, CACHE_REPOSITORY_DIR))
+
+		if CACHE_YOUNGEST_REV not in metadata:
+			raise TracError('Missing "youngest_rev" in cache metadata')
+
+		db.commit() # save metadata changes made up to now
+
+		git = self.repos.git
+		changed = git.sync()
+		stored_youngest = metadata[CACHE_YOUNGEST_REV] or None
+
+		# -- nothing to do if refs didn't change since the last sync
+		if not changed and stored_youngest is not None and \
+			    stored_youngest == getattr(self, 'youngest', None):
+			return
+
+		repos_youngest = git.youngest_rev()
+		if stored_youngest == repos_youngest:
+			cursor.execute("SELECT COUNT(*) FROM revision")
+			if cursor.fetchone()[0] == len(git.get_commits()):
+				self.youngest = stored_youngest
+				return
+
+		cursor.execute("SELECT rev FROM revision")
+		cached_revs = set(str(row[0]) for row in cursor)
+
+		kindmap = dict(zip(_kindmap.values(), _kindmap.keys()))
+		actionmap = dict(zip(_actionmap.values(), _actionmap.keys()))
+
+		def __store_batch(last_rev):
+			cursor.execute("UPDATE system SET value=%s WHERE name=%s",
+				       (last_rev, CACHE_YOUNGEST_REV))
+			db.commit()
+
+		pending = 0
+		rev = None
+		for rev, commit, parent_changes in git.log_changes(cached_revs):
+			try:
+				cursor.execute("INSERT INTO revision (rev,time,author,message) "
+					       "VALUES (%s,%s,%s,%s)",
+					       (rev, commit.committer_time, commit.committer,
+						commit.message))
+			except Exception, e:
+				# another process is syncing the same revisions
+				self.log.warning('Revision %s already cached: %s' % (rev, e))
+				db.rollback()
+				return
+
+			for path,kind,action,base_path,base_rev in _iter_changes(parent_changes):
+				cursor.execute("INSERT INTO node_change "
+					       "(rev,path,node_type,change_type,base_path,base_rev) "
+					       "VALUES (%s,%s,%s,%s,%s,%s)",
+					       (rev, path, kindmap[kind], actionmap[action],
+						base_path, base_rev))
+
+			pending += 1
+			if pending >= self.sync_batch:
+				__store_batch(rev)
+				pending = 0
+
+			if feedback:
+				feedback(rev)
+
+		if rev is not None:
+			self.log.info("cached git revisions up to [%s]" % rev)
+
+		if repos_youngest != stored_youngest or pending:
+			__store_batch(repos_youngest)
+
+		self.youngest = repos_youngest
+
 from genshi.builder import tag
 from genshi.core import Markup, escape
 
 from datetime import datetime
-import time, sys
+import os, re, time, sys, threading, tempfile
 
 if not sys.version_info[:2] >= (2,5):
 	raise TracError("python >= 2.5 dependancy not met")
 
 import PyGIT
 
-def _last_iterable(iterable):
-	"helper for detecting last iteration in for-loop"
-        i = iter(iterable)
-        v = i.next()
-        for nextv in i:
-		yield False, v
-		v = nextv
-	yield True, v
-
-# helper
-def _parse_user_time(s):
-	"""parse author/committer attribute lines and return
-	(user,timestamp)"""
-	(user,time,tz_str) = s.rsplit(None, 2)
-	tz = FixedOffset((int(tz_str)*6)/10, tz_str)
-	time = datetime.fromtimestamp(float(time), tz)
-	return (user,time)
+# helpers
+_tz_cache = {}
+
+def _get_tz(tz_str):
+	"return (shared) FixedOffset instance for git timezone string"
+	try:
+		return _tz_cache[tz_str]
+	except KeyError:
+		return _tz_cache.setdefault(tz_str, FixedOffset((int(tz_str)*6)/10, tz_str))
+
+def _user_time(user, ts, tz_str):
+	"return (user,datetime) for author/committer fields of a Commit"
+	return (user, datetime.fromtimestamp(ts, _get_tz(tz_str)))
+
+def _iter_changes(parent_changes):
+	"""turn (parent, diff_tree records) pairs into tuples as returned by
+	Changeset.get_changes()"""
+	paths_seen = set()
+	for parent, diff_records in parent_changes:
+		for mode1,mode2,obj1,obj2,action,path1,path2 in diff_records:
+			path = path2 or path1
+			p_path, p_rev = path1, parent
+
+			kind = Node.FILE
+			if mode2.startswith('04') or mode1.startswith('04'):
+				kind = Node.DIRECTORY
+
+			action = GitChangeset.action_map[action[0]]
+
+			if action == Changeset.ADD:
+				p_path = ''
+				p_rev = None
+
+			# CachedRepository expects unique (rev, path, change_type) key
+			# this is only an issue in case of merges where files required editing
+			if path in paths_seen:
+				continue
+
+			paths_seen.add(path)
+
+			yield (path, kind, action, p_path, p_rev)
 
 class GitConnector(Component):
 	implements(IRepositoryConnector, IWikiSyntaxProvider, IPropertyRenderer)
@@ -74,6 +207,34 @@ class GitConnector(Component):
 				self.log.error("GIT version %s installed not compatible (need >= %s)" %
 					       (self._version['v_str'], self._version['v_min_str']))
 
+		# cache warmup state, guarded by _warmup_lock
+		self._warmup_lock = threading.Lock()
+		self._warmup_started = False
+		self._warm_repos = None
+		self._repos_fetched = False
+
+	def _warmup(self, dir):
+		"fill the caches of the repository's storage (run in a background thread)"
+		# a GitRepository of its own (sharing the storage), as the ones
+		# handed out are closed by RepositoryManager after each request
+		repos = None
+		try:
+			start = time.time()
+			repos = self._open_repository(dir)
+			repos.git.warmup(self._warmup_commits)
+			self.log.info("warmed up caches for '%s' in %.2fs" % (dir, time.time() - start))
+		except Exception, e:
+			self.log.warning("cache warmup for '%s' failed: %s" % (dir, e))
+
+		# RepositoryManager drops its reference after each request, so
+		# keep the storage (and thus its caches) alive until used again
+		self._warmup_lock.acquire()
+		try:
+			if not self._repos_fetched:
+				self._warm_repos = repos
+		finally:
+			self._warmup_lock.release()
+
 	def _format_sha_link(self, formatter, ns, sha, label, fullmatch=None):
 		try:
 			changeset = self.env.get_repository().get_changeset(sha)
@@ -91,7 +252,7 @@ class GitConnector(Component):
 	# relied upon by GitChangeset
 
         def match_property(self, name, mode):
-		if name in ('Parents','Children','git-committer','git-author') \
+		if name in ('Parents','Children','Branches','Tags','git-committer','git-author') \
 			    and mode == 'revprop':
 			return 8 # default renderer has priority 1
 		return 0
@@ -106,6 +267,19 @@ class GitConnector(Component):
 			return tag([tag(sha_link(rev), ', ') for rev in revs[:-1]],
 				   sha_link(revs[-1]))
 
+		if name in ('Branches','Tags'):
+			def ref_link(name):
+				return tag.a(name, class_="source",
+					     href=context.href.log('/', rev=name))
+
+			names = props[name]
+			links = [tag(ref_link(ref), ', ') for ref in names[:self._max_ref_links]]
+			if len(names) > self._max_ref_links:
+				links.append("... (%d more)" % (len(names) - self._max_ref_links))
+			else:
+				links[-1] = ref_link(names[-1])
+			return tag(links)
+
 		if name in ('git-committer', 'git-author'):
 			user_,time_ = props[name]
 			_str = user_ + " / " + time_.strftime('%Y-%m-%dT%H:%M:%SZ%z')
@@ -113,6 +287,9 @@ class GitConnector(Component):
 
 		raise TracError("internal error")
 
+	# longer ref lists shown on the changeset page are truncated
+	_max_ref_links = 100
+
 	#######################
 	# IWikiSyntaxProvider
 
@@ -137,6 +314,56 @@ class GitConnector(Component):
 				  "length rev sha sums should be tried to be abbreviated to"
 				  " (must be >= 4 and <= 40)")
 
+	_background_rebuild = BoolOption('git', 'background_rebuild', 'false',
+					 "rebuild the commit tree cache in a background thread"
+					 " after repository changes, while requests keep being"
+					 " served from the previous one")
+
+	_max_staleness = IntOption('git', 'max_staleness', 30,
+				   "maximum age in seconds of an outdated commit tree"
+				   " cache served during a background rebuild")
+
+	_use_inotify = BoolOption('git', 'use_inotify', 'false',
+				  "watch ref files with inotify (Linux only) instead of"
+				  " stat()ing them on every request for detecting changes")
+
+	_max_concurrency = IntOption('git', 'max_concurrency', 4,
+				     "maximum number of git processes run in parallel"
+				     " for batched lookups within a request")
+
+	_cache_memory_budget = IntOption('git', 'cache_memory_budget', 0,
+					 "upper limit (in MB) for the estimated memory used by the"
+					 " caches of all repositories in this process; the caches"
+					 " of the least recently used repositories are dropped"
+					 " when exceeded (0 means no limit)")
+
+	_cache_warmup = BoolOption('git', 'cache_warmup', 'false',
+				   "fill the caches in a background thread when the"
+				   " repository is first used (keeps the warmed up"
+				   " caches until it is used again)")
+
+	_warmup_commits = IntOption('git', 'warmup_commits', 50,
+				    "number of recent commits preloaded by `cache_warmup`")
+
+	_include_refs = ListOption('git', 'include_refs', '',
+				   doc="refs (comma separated glob patterns, e.g. `refs/heads/*`)"
+				   " whose history is shown; all refs if empty")
+
+	_exclude_refs = ListOption('git', 'exclude_refs', '',
+				   doc="refs (comma separated glob patterns, e.g. `refs/pull/*`)"
+				   " ignored for the commit tree, timeline and branch/tag"
+				   " listings; HEAD is always included")
+
+	_notify_spool = PathOption('git', 'notify_spool', '',
+				   "spool directory written by the post-receive hook"
+				   " `contrib/trac-post-receive`; if set, pushed ref updates"
+				   " are applied in the background ahead of requests, which"
+				   " only pick up ref changes made otherwise")
+
+	_cached_sync_batch = IntOption('git', 'cached_sync_batch', 100,
+				       "number of revisions stored per database transaction"
+				       " when syncing the `CachedRepository`")
+
 	_git_bin = PathOption('git', 'git_bin', '/usr/bin/git', "path to git executable (relative to trac project folder!)")
 
 
@@ -153,27 +380,64 @@ class GitConnector(Component):
 			raise TracError("GIT version %s installed not compatible (need >= %s)" %
 					(self._version['v_str'], self._version['v_min_str']))
 
-		repos = GitRepository(dir, self.log,
-				      persistent_cache=self._persistent_cache,
-				      git_bin=self._git_bin,
-				      shortrev_len=self._shortrev_len)
+		repos = self._open_repository(dir)
+
+		# the first fetch starts the cache warmup; once the repository is
+		# used again, its storage is subject to the weak cache and memory
+		# budget like without warmup
+		self._warmup_lock.acquire()
+		try:
+			if not self._warmup_started:
+				self._warmup_started = True
+				if self._cache_warmup:
+					t = threading.Thread(target=self._warmup, args=(dir,))
+					t.setDaemon(True)
+					t.start()
+			else:
+				self._repos_fetched = True
+				self._warm_repos = None
+		finally:
+			self._warmup_lock.release()
 
 		if self._cached_repository:
-			repos = CachedRepository2(self.env.get_db_cnx(), repos, None, self.log)
+			repos = CachedRepository2(self.env.get_db_cnx(), repos, None, self.log,
+						  sync_batch=self._cached_sync_batch)
 			self.log.info("enabled CachedRepository for '%s'" % dir)
 		else:
 			self.log.info("disabled CachedRepository for '%s'" % dir)
 
 		return repos
 
+	def _open_repository(self, dir):
+		return GitRepository(dir, self.log,
+				     persistent_cache=self._persistent_cache,
+				     git_bin=self._git_bin,
+				     shortrev_len=self._shortrev_len,
+				     background_rebuild=self._background_rebuild,
+				     max_staleness=self._max_staleness,
+				     use_inotify=self._use_inotify,
+				     max_concurrency=self._max_concurrency,
+				     memory_budget=self._cache_memory_budget * 1024 * 1024,
+				     ref_filter=PyGIT.RefFilter(self._include_refs, self._exclude_refs),
+				     notify_spool=self._notify_spool)
+
 class GitRepository(Repository):
-	def __init__(self, path, log, persistent_cache=False, git_bin='git', shortrev_len=7):
+	def __init__(self, path, log, persistent_cache=False, git_bin='git', shortrev_len=7,
+		     background_rebuild=False, max_staleness=0, use_inotify=False,
+		     max_concurrency=4, memory_budget=0, ref_filter=None, notify_spool=None):
 		self.logger = log
 		self.gitrepo = path
 		self._shortrev_len = max(4, min(shortrev_len, 40))
 
 		self.git = PyGIT.StorageFactory(path, log, not persistent_cache,
-						git_bin=git_bin).getInstance()
+						git_bin=git_bin,
+						rebuild_in_background=background_rebuild,
+						max_staleness=max_staleness,
+						use_inotify=use_inotify,
+						max_concurrency=max_concurrency,
+						memory_budget=memory_budget,
+						ref_filter=ref_filter,
+						notify_spool=notify_spool).getInstance()
 		Repository.__init__(self, "git:"+path, None, log)
 
 	def close(self):
@@ -227,9 +491,23 @@ class GitRepository(Repository):
 		if old_path != new_path:
 			raise TracError("not supported in git_fs")
 
-		for chg in self.git.diff_tree(old_rev, new_rev, self.normalize_path(new_path)):
-			(mode1,mode2,obj1,obj2,action,path,path2) = chg
+		def ls_tree_info(mode, sha, path):
+			k = 'blob'
+			if mode.startswith('04'):
+				k = 'tree'
+			elif mode == '160000':
+				k = 'commit' # submodule
+			return (mode, k, sha, path, sizes.get(sha))
 
+		changes = list(self.git.diff_tree(old_rev, new_rev, self.normalize_path(new_path)))
+
+		# the nodes are made up from the diff records, along with the
+		# blob sizes looked up at once; the last change of a node is
+		# only looked up if asked for
+		sizes = self.git.get_obj_sizes([ sha for chg in changes for sha in chg[2:4]
+						 if sha != self.__NULL_SHA ])
+
+		for (mode1,mode2,obj1,obj2,action,path,path2) in changes:
 			kind = Node.FILE
 			if mode2.startswith('04') or mode1.startswith('04'):
 				kind = Node.DIRECTORY
@@ -240,12 +518,16 @@ class GitRepository(Repository):
 			new_node = None
 
 			if change != Changeset.ADD:
-				old_node = self.get_node(path, old_rev)
+				old_node = GitNode(self.git, path, old_rev, self.log,
+						   ls_tree_info(mode1, obj1, path))
 			if change != Changeset.DELETE:
-				new_node = self.get_node(path, new_rev)
+				new_node = GitNode(self.git, path, new_rev, self.log,
+						   ls_tree_info(mode2, obj2, path))
 
 			yield (old_node, new_node, kind, change)
 
+	__NULL_SHA = '0' * 40
+
 	def next_rev(self, rev, path=''):
 		return self.git.hist_next_revision(rev)
 
@@ -272,28 +554,41 @@ class GitRepository(Repository):
 				rev_callback(rev)
 
 class GitNode(Node):
-	def __init__(self, git, path, rev, log, ls_tree_info=None):
+	"""node at the last change of path before or at rev
+
+	Unless passed as last_rev, that last change (i.e. rev and
+	created_rev) is only looked up on first access; together with
+	ls_tree_info, creating a node needs no git calls at all."""
+
+	def __init__(self, git, path, rev, log, ls_tree_info=None, last_rev=None):
 		self.log = log
 		self.git = git
 		self.fs_sha = None # points to either tree or blobs
 		self.fs_perm = None
 		self.fs_size = None
 
+		# no rev means the youngest one, as for Repository.get_node()
+		if rev is None:
+			rev = git.youngest_rev()
+		self.__tree_rev = rev
+
 		kind = Node.DIRECTORY
 		p = path.strip('/')
 		if p: # ie. not the root-tree
                         if not ls_tree_info:
-				ls_tree_info = git.ls_tree(rev, p) or None
+				ls_tree_info = git.ls_tree(rev, p, long=True) or None
                                 if ls_tree_info:
                                         [ls_tree_info] = ls_tree_info
 
 			if not ls_tree_info:
 				raise NoSuchNode(path, rev)
 
-			(self.fs_perm, k, self.fs_sha, fn) = ls_tree_info
+			(self.fs_perm, k, self.fs_sha, fn) = ls_tree_info[:4]
+			if len(ls_tree_info) > 4:
+				self.fs_size = ls_tree_info[4]
 
 			# fix-up to the last commit-rev that touched this node
-			rev = self.git.last_change(rev, p)
+			rev = last_rev
 
 			if k=='tree':
 				pass
@@ -303,10 +598,20 @@ class GitNode(Node):
 				raise TracError("internal error (got unexpected object kind '%s')" % k)
 
 		self.created_path = path
-		self.created_rev = rev
 
 		Node.__init__(self, path, rev, kind)
 
+	def __get_rev(self):
+		if self.__rev is None:
+			self.__rev = self.git.last_change(self.__tree_rev, self.path.strip('/'))
+		return self.__rev
+
+	def __set_rev(self, rev):
+		self.__rev = rev
+
+	rev = property(__get_rev, __set_rev)
+	created_rev = property(__get_rev)
+
 	def __git_path(self):
 		"return path as expected by PyGIT"
 		p = self.path.strip('/')
@@ -322,7 +627,9 @@ class GitNode(Node):
 		if not self.isfile:
 			return None
 
-		return self.git.get_file(self.fs_sha)
+		# streamed, so large blobs are never held in memory as a whole
+		# (Trac reads the content chunk-wise for previews and downloads)
+		return self.git.get_file_stream(self.fs_sha)
 
 	def get_properties(self):
 		return self.fs_perm and {'mode': self.fs_perm } or {}
@@ -337,14 +644,22 @@ class GitNode(Node):
 		if not self.isdir:
 			return
 
-		for ent in self.git.ls_tree(self.rev, self.__git_path()):
-			yield GitNode(self.git, ent[3], self.rev, self.log, ent)
+		# sizes are listed along, so get_content_length() needs no git call
+		entries = self.git.ls_tree(self.rev, self.__git_path(), long=True)
+		# look up the last change of all entries at once
+		last_revs = self.git.last_changes(self.rev, [ ent[3] for ent in entries ])
+		for ent in entries:
+			yield GitNode(self.git, ent[3], self.rev, self.log, ent, last_revs[ent[3]])
 
 	def get_content_type(self):
 		if self.isdir:
 			return None
 
-		return ''
+		# leave the MIME type to Trac's Mimeview (honoring [mimeviewer]
+		# mime_map), only flagging binary content, which is determined
+		# from the leading bytes instead of the whole blob
+		size, binary = self.git.probe_blob(self.fs_sha)
+		return binary and 'application/octet-stream' or ''
 
 	def get_content_length(self):
 		if not self.isfile:
@@ -356,17 +671,39 @@ class GitNode(Node):
 		return self.fs_size
 
 	def get_history(self, limit=None):
-		# TODO: find a way to follow renames/copies
-		for is_last,rev in _last_iterable(self.git.history(self.rev, self.__git_path(), limit)):
-			yield (self.path, rev, Changeset.EDIT if not is_last else Changeset.ADD)
+		# renames are followed by stitching together the histories of
+		# the old and new path, as recorded in the rename index
+		path, git_path, rev = self.path, self.__git_path(), self.rev
+		while True:
+			walk = self.git.history_walk(rev, git_path)
+			revs = walk.revs(0, limit)
+			source = None
+			for idx,rev in enumerate(revs):
+				chg = Changeset.EDIT
+				if walk.is_last(idx):
+					source = self.git.rename_source(rev, git_path)
+					chg = source and Changeset.MOVE or Changeset.ADD
+				yield (path, rev, chg)
+
+			if not source:
+				return
+			if limit is not None:
+				limit -= len(revs)
+				if limit <= 0:
+					return
+
+			rev, old_path = source
+			path = path[:len(path) - len(path.lstrip('/'))] + old_path
+			git_path = self.isdir and old_path + '/' or old_path
 
 	def get_last_modified(self):
 		if not self.isfile:
 			return None
 
 		try:
-			msg, props = self.git.read_commit(self.rev)
-			user,ts = _parse_user_time(props['committer'][0])
+			commit = self.git.read_commit(self.rev)
+			user,ts = _user_time(commit.committer, commit.committer_time,
+					     commit.committer_tz)
 		except:
 			self.log.error("internal error (could not get timestamp from commit '%s')" % self.rev)
 			return None
@@ -387,60 +724,237 @@ class GitChangeset(Changeset):
 	def __init__(self, git, sha):
 		self.git = git
 		try:
-			(msg, props) = git.read_commit(sha)
+			commit = git.read_commit(sha)
 		except PyGIT.GitErrorSha:
 			raise NoSuchChangeset(sha)
-		self.props = props
+		# shared with PyGIT's cache, not to be modified
+		self.commit = commit
+		self.children = list(git.children(sha))
 
-		assert 'children' not in props
-		_children = list(git.children(sha))
-		if _children:
-			props['children'] = _children
+		(user_, time_) = _user_time(commit.committer, commit.committer_time,
+					    commit.committer_tz)
 
-		# use 1st committer as changeset owner/timestamp
-		(user_, time_) = _parse_user_time(props['committer'][0])
-
-		Changeset.__init__(self, sha, msg, user_, time_)
+		Changeset.__init__(self, sha, commit.message, user_, time_)
 
 	def get_properties(self):
+		commit = self.commit
 		properties = {}
-		if 'parent' in self.props:
-			properties['Parents'] = self.props['parent']
-		if 'children' in self.props:
-			properties['Children'] = self.props['children']
-		if 'committer' in self.props:
-			properties['git-committer'] = \
-			    _parse_user_time(self.props['committer'][0])
-		if 'author' in self.props:
-			git_author = _parse_user_time(self.props['author'][0])
-			if not properties.get('git-committer') == git_author:
-				properties['git-author'] = git_author
+		if commit.parents:
+			properties['Parents'] = list(commit.parents)
+		if self.children:
+			properties['Children'] = self.children
+
+		# refs the commit is reachable from
+		branches, tags = [], []
+		for refname in self.git.refs_containing(self.rev):
+			if refname.startswith('refs/heads/'):
+				branches.append(refname[11:])
+			elif refname.startswith('refs/tags/'):
+				tags.append(refname[10:])
+		if branches:
+			properties['Branches'] = branches
+		if tags:
+			properties['Tags'] = tags
+
+		properties['git-committer'] = (self.author, self.date)
+		git_author = _user_time(commit.author, commit.author_time, commit.author_tz)
+		if not properties['git-committer'] == git_author:
+			properties['git-author'] = git_author
 
 		return properties
 
 	def get_changes(self):
-		paths_seen = set()
-		for parent in self.props.get('parent', [None]):
-			for mode1,mode2,obj1,obj2,action,path1,path2 in \
-				    self.git.diff_tree(parent, self.rev, find_renames=True):
-				path = path2 or path1
-				p_path, p_rev = path1, parent
+		return _iter_changes((parent, self.git.diff_tree(parent, self.rev,
+								 find_renames=True))
+				     for parent in self.commit.parents or [None])
 
-				kind = Node.FILE
-				if mode2.startswith('04') or mode1.startswith('04'):
-					kind = Node.DIRECTORY
+class GitCacheAdminPanel(Component):
+	"shows the cache statistics of the PyGIT.Storage instances of this process"
+
+	implements(IAdminPanelProvider, ITemplateProvider)
+
+	#######################
+	# IAdminPanelProvider
+
+	def get_admin_panels(self, req):
+		if 'TRAC_ADMIN' in req.perm:
+			yield ('versioncontrol', 'Version Control', 'gitcache', 'GIT Caches')
+
+	def render_admin_panel(self, req, category, page, path_info):
+		req.perm.require('TRAC_ADMIN')
+
+		if req.method == 'POST' and req.args.get('path'):
+			PyGIT.StorageFactory.clear(req.args['path'])
+			req.redirect(req.href.admin(category, page))
+
+		return 'admin_gitcache.html', {'stats': PyGIT.StorageFactory.stats()}
+
+	#######################
+	# ITemplateProvider
+
+	def get_htdocs_dirs(self):
+		return []
+
+	def get_templates_dirs(self):
+		from pkg_resources import resource_filename
+		return [resource_filename(__name__, 'templates')]
+
+class GitArchiveModule(Component):
+	"""download of directory snapshots, streamed from `git archive`
 
-				action = GitChangeset.action_map[action[0]]
+	Archives of tagged revisions are kept in `archive_cache_dir` (if
+	set), keyed by tree sha, and served from there afterwards."""
 
-				if action == Changeset.ADD:
-					p_path = ''
-					p_rev = None
+	implements(IRequestHandler, IRequestFilter)
 
-				# CachedRepository expects unique (rev, path, change_type) key
-				# this is only an issue in case of merges where files required editing
-				if path in paths_seen:
-					continue
+	_archive_max_concurrency = IntOption('git', 'archive_max_concurrency', 2,
+					     "maximum number of archive downloads generated at"
+					     " the same time by this process; further requests"
+					     " are answered with `503 Service Unavailable`")
 
-				paths_seen.add(path)
+	_archive_cache_dir = PathOption('git', 'archive_cache_dir', '',
+					"directory for caching the archives of tagged"
+					" revisions (relative to trac project folder!);"
+					" no caching if empty")
 
-				yield (path, kind, action, p_path, p_rev)
+	# format -> (file name extension, mimetype, label)
+	_formats = {
+		'zip': ('zip', 'application/zip', 'Zip Archive'),
+		'tar.gz': ('tar.gz', 'application/x-gzip', 'Tarball'),
+		}
+
+	def __init__(self):
+		self._slots = threading.BoundedSemaphore(max(1, self._archive_max_concurrency))
+
+	#######################
+	# IRequestFilter
+
+	def pre_process_request(self, req, handler):
+		return handler
+
+	def post_process_request(self, req, template, data, content_type):
+		if template == 'browser.html' and data and data.get('dir') and \
+			    'BROWSER_VIEW' in req.perm and \
+			    self.config.get('trac', 'repository_type') == 'git':
+			rev = data.get('stickyrev') or data.get('rev')
+			for format in ('zip', 'tar.gz'):
+				ext, mimetype, label = self._formats[format]
+				add_link(req, 'alternate',
+					 req.href.archive(data['path'], rev=rev, format=format),
+					 label, mimetype, format)
+		return template, data, content_type
+
+	#######################
+	# IRequestHandler
+
+	def match_request(self, req):
+		match = re.match(r'/archive(/.*)?$', req.path_info)
+		if match:
+			req.args['path'] = match.group(1) or '/'
+			return True
+
+	def process_request(self, req):
+		req.perm.require('BROWSER_VIEW')
+
+		format = req.args.get('format', 'zip')
+		if format not in self._formats:
+			raise TracError("Unsupported archive format '%s'" % format)
+		ext, mimetype, label = self._formats[format]
+
+		repos = self.env.get_repository(req.authname)
+		git = getattr(repos, 'repos', repos).git # unwrap CachedRepository
+
+		path = repos.normalize_path(req.args.get('path'))
+		rev_arg = req.args.get('rev')
+		rev = repos.normalize_rev(rev_arg)
+
+		node = repos.get_node(path, rev)
+		if not node.isdir:
+			raise TracError("'%s' is not a directory" % path)
+
+		# a tree keeps its sha between revisions, a commit gives the
+		# archive entries its commit time
+		treeish = path and node.fs_sha or rev
+
+		# e.g. 'repo-v1.0' or 'dir-1a2b3c4'
+		if rev_arg and rev_arg in git.get_tags():
+			rev_label = rev_arg
+		else:
+			rev_label = repos.short_rev(rev)
+		name = path.split('/')[-1]
+		if not name:
+			repos_dir = getattr(repos, 'repos', repos).gitrepo.rstrip('/')
+			if repos_dir.endswith('/.git'):
+				repos_dir = repos_dir[:-5]
+			name = os.path.basename(repos_dir)
+			if name.endswith('.git'):
+				name = name[:-4]
+		prefix = re.sub(r'[^\w.+-]', '_', '%s-%s' % (name or 'archive', rev_label))
+		filename = '%s.%s' % (prefix, ext)
+
+		cache_path = None
+		if self._archive_cache_dir and \
+			    rev in [ peeled for refname, (sha, peeled) in git.get_ref_cache()[2].iteritems()
+				     if refname.startswith('refs/tags/') ]:
+			tree = node.fs_sha or git.read_commit(rev).tree
+			cache_path = os.path.join(self._archive_cache_dir,
+						  '%s-%s.%s' % (tree, prefix, ext))
+			if os.path.isfile(cache_path):
+				req.send_header('Content-Disposition', 'attachment; filename="%s"' % filename)
+				req.send_file(cache_path, mimetype)
+
+		if not self._slots.acquire(False):
+			raise HTTPServiceUnavailable("Too many archive downloads in progress,"
+						     " please try again later.")
+		try:
+			self._send_archive(req, git, treeish, format, prefix, filename,
+					   mimetype, cache_path)
+		finally:
+			self._slots.release()
+
+		raise RequestDone
+
+	def _send_archive(self, req, git, treeish, format, prefix, filename, mimetype, cache_path):
+		"stream archive to the client, copying it to cache_path if given"
+		pipe = git.archive(treeish, format, prefix + '/')
+		cache_file = tmp_path = None
+		try:
+			chunk = pipe.read(0x10000)
+			if not chunk:
+				raise TracError("Creating the archive failed")
+
+			req.send_response(200)
+			req.send_header('Content-Type', mimetype)
+			req.send_header('Content-Disposition', 'attachment; filename="%s"' % filename)
+			req.end_headers()
+
+			if cache_path:
+				try:
+					if not os.path.isdir(self._archive_cache_dir):
+						os.makedirs(self._archive_cache_dir)
+					fd, tmp_path = tempfile.mkstemp(prefix='.tmp-',
+									dir=self._archive_cache_dir)
+					cache_file = os.fdopen(fd, 'wb')
+				except (IOError, OSError), e:
+					self.log.warning("not caching archive %s: %s" % (filename, e))
+
+			while chunk:
+				req.write(chunk)
+				if cache_file:
+					cache_file.write(chunk)
+				chunk = pipe.read(0x10000)
+
+			if cache_file:
+				cache_file.close()
+				cache_file = None
+				os.rename(tmp_path, cache_path)
+				tmp_path = None
+		finally:
+			pipe.close()
+			if cache_file:
+				cache_file.close()
+			if tmp_path:
+				try:
+					os.unlink(tmp_path)
+				except OSError:
+					pass
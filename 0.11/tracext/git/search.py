@@ -0,0 +1,392 @@
+# -*- coding: iso-8859-1 -*-
+#
+# Copyright (C) 2006,2008 Herbert Valerio Riedel <hvr@gnu.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+from __future__ import with_statement
+
+from array import array
+from threading import Lock, Thread
+import os, re, sys, time, marshal
+
+# trigram index of the text blobs reachable from some branches; the
+# search module below needs Trac, the index itself only PyGIT
+try:
+	from trac.core import *
+	from trac.config import IntOption, ListOption, Option
+	from trac.search import ISearchSource, shorten_result
+	from git_fs import _user_time
+except ImportError:
+	Component = None
+
+import PyGIT
+
+class TrigramIndex(object):
+	"""maps the (lowercased) trigrams occurring within the words of text
+	blobs to the blobs containing them
+
+	Only trigrams within words are indexed, which keeps both indexing
+	time and the number of postings at about half of indexing every
+	trigram; as each word of a search term is part of some word of the
+	text it occurs in, lookups still yield all matching blobs.
+
+	Blobs are indexed once by sha, so files unchanged between branches
+	or revisions are never indexed again. Postings are arrays of blob
+	ids, which are assigned in indexing order and thus keep them
+	sorted. The index yields candidates only; matches need to be
+	verified (e.g. by 'git grep'), as trigrams don't record their
+	positions.
+
+	An index is updated by a single thread; once saved, it's only read
+	(cf. GitSearchModule)."""
+
+	VERSION = 1
+
+	_words = re.compile(r'\w{3,}')
+
+	def __init__(self):
+		self.shas = []		# blob id -> sha
+		self.ids = {}		# sha -> blob id
+		self.postings = {}	# trigram -> array of blob ids
+		self.trees = {}		# branch -> (tip, [(path, sha), ...])
+
+	def __len__(self):
+		return len(self.shas)
+
+	def __contains__(self, sha):
+		return sha in self.ids
+
+	@classmethod
+	def trigrams(cls, text):
+		"set of the trigrams within the (distinct) words of lowercased text"
+		tris = set()
+		for word in set(cls._words.findall(text.lower())):
+			n = len(word) - 2
+			tris.update(map(word.__getslice__, xrange(n), xrange(3, n + 3)))
+		return tris
+
+	def add(self, sha, text):
+		bid = len(self.shas)
+		self.shas.append(sha)
+		self.ids[sha] = bid
+
+		postings = self.postings
+		get = postings.get
+		for tri in self.trigrams(text):
+			ids = get(tri)
+			if ids is None:
+				postings[tri] = array('i', [bid])
+			else:
+				ids.append(bid)
+
+	def candidates(self, terms):
+		"""return set of the shas of the blobs which may contain all terms,
+		or None if the terms are too short for narrowing the search"""
+		result = None
+		for tri in self.trigrams(' '.join(terms)):
+			ids = self.postings.get(tri)
+			if ids is None:
+				return set()
+			result = result is None and set(ids) or result.intersection(ids)
+			if not result:
+				return set()
+		if result is None:
+			return None
+		return set(self.shas[bid] for bid in result)
+
+	def compact(self, live):
+		"drop all blobs whose sha isn't in live, renumbering the others"
+		remap = array('i', [-1]) * len(self.shas)
+		shas = []
+		for bid, sha in enumerate(self.shas):
+			if sha in live:
+				remap[bid] = len(shas)
+				shas.append(sha)
+
+		postings = {}
+		for tri, ids in self.postings.iteritems():
+			ids = array('i', [ remap[bid] for bid in ids if remap[bid] >= 0 ])
+			if ids:
+				postings[tri] = ids
+
+		self.shas = shas
+		self.ids = dict((sha, bid) for bid, sha in enumerate(shas))
+		self.postings = postings
+
+	def update(self, git, branches, max_size=1024*1024, log=None):
+		"""index the text blobs (up to max_size bytes) reachable from
+		branches, a list of (name, tip) tuples, which are not indexed yet;
+		returns the number of newly indexed blobs"""
+		new_shas = set()
+		trees = {}
+		for name, tip in branches:
+			if name in self.trees and self.trees[name][0] == tip:
+				trees[name] = self.trees[name]
+				continue
+			entries = []
+			for mode, kind, sha, path, size in git.ls_tree(tip, long=True, recursive=True):
+				if kind != 'blob' or size > max_size:
+					continue
+				entries.append((path, sha))
+				if sha not in self.ids:
+					new_shas.add(sha)
+			trees[name] = tip, entries
+		self.trees = trees
+
+		count = 0
+		for sha, content in git.iter_blobs(new_shas):
+			# skip binary blobs, like git does
+			if '\0' in content[:PyGIT.Storage.BLOB_PROBE_SIZE]:
+				self.add(sha, '')
+			else:
+				self.add(sha, content)
+			count += 1
+
+		# renumber once half of the indexed blobs are unreachable
+		live = set(sha for tip, entries in trees.itervalues() for path, sha in entries)
+		if len(live) < len(self.shas) / 2:
+			if log:
+				log.debug("compacting search index (%d of %d blobs reachable)"
+					  % (len(live), len(self.shas)))
+			self.compact(live)
+
+		return count
+
+	def save(self, path):
+		"write index to path (atomically replaced)"
+		data = {'version': self.VERSION,
+			'shas': self.shas,
+			'postings': dict((tri, ids.tostring()) for tri, ids in self.postings.iteritems()),
+			'trees': self.trees}
+		tmp_path = '%s.tmp-%d' % (path, os.getpid())
+		f = open(tmp_path, 'wb')
+		try:
+			marshal.dump(data, f)
+		finally:
+			f.close()
+		os.rename(tmp_path, path)
+
+	def load(self, path):
+		"read index written by save(); returns False if there is none"
+		try:
+			f = open(path, 'rb')
+		except IOError:
+			return False
+		try:
+			data = marshal.load(f)
+		finally:
+			f.close()
+		if data.get('version') != self.VERSION:
+			return False
+
+		self.shas = data['shas']
+		self.ids = dict((sha, bid) for bid, sha in enumerate(self.shas))
+		self.postings = dict((tri, array('i', ids)) for tri, ids in data['postings'].iteritems())
+		self.trees = data['trees']
+		return True
+
+if Component is not None:
+
+	class GitSearchModule(Component):
+		"""search in the files of the repository, using a trigram index
+		of the text blobs to narrow down the files `git grep` checks"""
+
+		implements(ISearchSource)
+
+		_search_branches = ListOption('git', 'search_branches', '',
+					      doc="branches whose files are searched;"
+					      " the branch HEAD refers to if empty")
+
+		_search_index_dir = Option('git', 'search_index_dir', 'git-search',
+					   "directory for the search index files (relative"
+					   " to the environment directory)")
+
+		_search_max_file_size = IntOption('git', 'search_max_file_size', 1024,
+						  "size limit (in KB) of files being searched")
+
+		_search_max_results = IntOption('git', 'search_max_results', 200,
+						"maximum number of files listed as search results")
+
+		# last saved index per repository, and repositories whose index
+		# is being updated (per process)
+		_indexes = {}
+		_updating = set()
+		_indexes_lock = Lock()
+
+		#######################
+		# ISearchSource
+
+		def get_search_filters(self, req):
+			if 'BROWSER_VIEW' in req.perm and 'FILE_VIEW' in req.perm and \
+				    self.config.get('trac', 'repository_type') == 'git':
+				yield ('source', 'Source Code', False)
+
+		def get_search_results(self, req, terms, filters):
+			if 'source' not in filters:
+				return
+
+			repos = self.env.get_repository(req.authname)
+			git = getattr(repos, 'repos', repos).git # unwrap CachedRepository
+
+			branches = dict(git.get_branches())
+			names = self._search_branches or [ name for name, sha in git.get_branches()[:1] ]
+			branches = [ (name, branches[name]) for name in names if name in branches ]
+
+			# search the last saved index, bringing it up to date in the
+			# background; branches are searched as of their indexed tip
+			index = self._get_index(repos.name)
+			current = dict(branches)
+			if [ index.trees.get(name, (None,))[0] for name, tip in branches ] != \
+				    [ tip for name, tip in branches ]:
+				self._start_update(git, repos.name, branches)
+
+			# git works on bytes, shorten_result() below on unicode
+			git_terms = [ isinstance(term, unicode) and term.encode('utf-8') or term
+				      for term in terms ]
+			candidates = index.candidates(git_terms)
+
+			# verify the candidates, reporting the first matching line
+			# of each file; a blob is listed only once per path
+			matches = []
+			seen = set()
+			for name, tip in branches:
+				if name in index.trees:
+					tip, entries = index.trees[name]
+					paths = [ path for path, sha in entries
+						  if (candidates is None or sha in candidates) and
+						  (path, sha) not in seen ]
+					if not paths:
+						continue
+					if candidates is None:
+						paths = None
+				else:
+					# not indexed yet, search the whole tree
+					entries = paths = None
+				shas = dict(entries or [])
+				last_path = None
+				for path, lineno, line in git.grep(tip, git_terms, paths):
+					if path == last_path or (path, shas.get(path)) in seen:
+						continue
+					last_path = path
+					seen.add((path, shas.get(path)))
+					matches.append((name, tip, path, lineno, line))
+					if len(matches) >= self._search_max_results:
+						break
+				if len(matches) >= self._search_max_results:
+					break
+
+			# results are dated by the commit searched, looking up the
+			# last change of each file would take a history walk each
+			tip_info = {}
+			for name, tip, path, lineno, line in matches:
+				if tip not in tip_info:
+					commit = git.read_commit(tip)
+					tip_info[tip] = _user_time(commit.author, commit.author_time,
+								   commit.author_tz)
+				user, date = tip_info[tip]
+				line = line.decode('utf-8', 'replace')
+				# link the revision searched if the branch moved on since
+				rev = tip != current[name] and tip or name
+				yield (req.href.browser(path, rev=rev) + '#L%d' % lineno,
+				       '%s (%s)' % (path, name), date, user,
+				       shorten_result(line, terms))
+
+		def _index_path(self, repos_name):
+			index_dir = os.path.join(self.env.path, self._search_index_dir)
+			if not os.path.isdir(index_dir):
+				os.makedirs(index_dir)
+			return os.path.join(index_dir, '%s.idx' % PyGIT.sha1(repos_name).hexdigest()[:16])
+
+		def _get_index(self, repos_name):
+			"return the last saved index of the repository (never modified)"
+			with self._indexes_lock:
+				index = self._indexes.get(repos_name)
+				if index is None:
+					index = TrigramIndex()
+					if index.load(self._index_path(repos_name)):
+						self.log.debug("loaded search index with %d blobs" % len(index))
+					self._indexes[repos_name] = index
+				return index
+
+		def _start_update(self, git, repos_name, branches):
+			"update the index in a background thread, unless it's running already"
+			with self._indexes_lock:
+				if repos_name in self._updating:
+					return
+				self._updating.add(repos_name)
+			t = Thread(target=self._update, args=(git, repos_name, branches))
+			t.setDaemon(True)
+			t.start()
+
+		def _update(self, git, repos_name, branches):
+			"""update a copy of the saved index (read from disk, as searches
+			keep using the saved one meanwhile), save and publish it"""
+			try:
+				try:
+					start = time.time()
+					path = self._index_path(repos_name)
+					index = TrigramIndex()
+					index.load(path)
+					trees = dict(index.trees)
+					count = index.update(git, branches, self._search_max_file_size * 1024, self.log)
+					if count:
+						self.log.info("indexed %d blobs for search in %.2fs"
+							      % (count, time.time() - start))
+					if count or index.trees != trees:
+						index.save(path)
+					with self._indexes_lock:
+						self._indexes[repos_name] = index
+				except Exception, e:
+					self.log.warning("updating search index failed: %s" % e)
+			finally:
+				with self._indexes_lock:
+					self._updating.discard(repos_name)
+
+############################################################################
+############################################################################
+############################################################################
+
+if __name__ == '__main__':
+	# indexing throughput: search.py <git_dir> [<branch>...]
+	import logging
+
+	logging.basicConfig()
+	git = PyGIT.Storage(sys.argv[1], logging.getLogger())
+	names = sys.argv[2:] or [ name for name, sha in git.get_branches()[:1] ]
+	tips = dict(git.get_branches())
+	branches = [ (name, tips[name]) for name in names ]
+
+	index = TrigramIndex()
+	start = time.time()
+	count = index.update(git, branches)
+	elapsed = time.time() - start
+
+	size = lines = 0
+	for sha, content in git.iter_blobs(index.shas):
+		size += len(content)
+		lines += content.count('\n')
+	postings = sum(map(len, index.postings.itervalues()))
+
+	print "indexed %d blobs (%d lines, %.1f MB) in %.2f sec" \
+	    % (count, lines, size / 1048576.0, elapsed)
+	print "  %.0f lines/sec, %.2f MB/sec" \
+	    % (lines / max(elapsed, 1e-6), size / 1048576.0 / max(elapsed, 1e-6))
+	print "  %d trigrams, %d postings" % (len(index.postings), postings)
+
+	start = time.time()
+	index.update(git, branches)
+	print "incremental update without changes: %.3f sec" % (time.time() - start)
+
+	for term in ('include', 'return', 'xyzzy'):
+		start = time.time()
+		candidates = index.candidates([term])
+		print "candidates for %r: %d in %.1f ms" % (term, len(candidates), (time.time() - start) * 1000)